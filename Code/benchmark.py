@@ -0,0 +1,210 @@
+import copy, itertools, sys, time
+import numpy as np
+import tensorflow as tf
+import utils
+import data_engine
+import train
+import metrics
+from fast_scorer import FastScorer
+from model import Model, beam_candidates
+
+def setup_model(params):
+    '''
+    Engine, model options and parameters to benchmark decoding with.
+    start_session restores the parameters from a checkpoint or initializes them randomly.
+    '''
+    engine = data_engine.engine_from_options(params)
+    options = dict(params)
+    options['ctx_dim'] = engine.ctx_dim
+    options['vocab_size'] = engine.vocab_size
+    model = Model()
+    tfparams = utils.init_tfparams(model.init_params(options))
+    use_noise = tf.Variable(False, dtype=tf.bool, trainable=False, name="use_noise")
+    return engine, model, options, tfparams, use_noise
+
+def start_session(tfparams, checkpoint=None):
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    if checkpoint:
+        print 'restoring %s'%checkpoint
+        tf.train.Saver(var_list=tfparams.values()).restore(sess, checkpoint)
+    return sess
+
+def time_gen_sample(sess, model, f_init, f_next, options, ctxs, ctx_masks, k=5, maxlen=30, restrict_vocs=None):
+    # decode every video with gen_sample, returns the best samples and the seconds spent per video
+    samples = []
+    durations = []
+    for i, (ctx, ctx_mask) in enumerate(zip(ctxs, ctx_masks)):
+        t0 = time.time()
+        sample, score, _, _ = model.gen_sample(sess, None, f_init, f_next, ctx, ctx_mask, options,
+                                               k=k, maxlen=maxlen, stochastic=False,
+                                               restrict_voc=restrict_vocs[i] if restrict_vocs else None)
+        durations.append(time.time() - t0)
+        samples.append(sample[np.argmin(score)])
+    return samples, np.asarray(durations)
+
+def benchmark_pctx_cache(params, n_videos=100, checkpoint=None):
+    # gen_sample latency on the validation set with and without caching the projected context
+    engine, model, options, tfparams, use_noise = setup_model(params)
+    CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+        BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER = train.sampler_placeholders(
+            options['ctx_frames'], options['ctx_dim'], options['lstm_dim'])
+    inputs = [CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER,
+              BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER]
+    f_init, f_next = model.build_sampler(tfparams, options, use_noise, *inputs)
+    f_init_cached, f_next_cached = model.build_sampler(tfparams, options, use_noise, *inputs,
+                                                       pctx_sampler=PCTX_SAMPLER)
+    ctxs, ctx_masks = engine.prepare_data_for_blue('val')
+    ctxs = ctxs[:n_videos]
+    ctx_masks = ctx_masks[:n_videos]
+    sess = start_session(tfparams, checkpoint)
+    # warm up both samplers before timing
+    time_gen_sample(sess, model, f_init, f_next, options, ctxs[:1], ctx_masks[:1])
+    time_gen_sample(sess, model, f_init_cached, f_next_cached, options, ctxs[:1], ctx_masks[:1])
+    samples, durations = time_gen_sample(sess, model, f_init, f_next, options, ctxs, ctx_masks)
+    samples_cached, durations_cached = time_gen_sample(sess, model, f_init_cached, f_next_cached,
+                                                       options, ctxs, ctx_masks)
+    sess.close()
+    print 'decoded %d validation videos with beam 5'%len(ctxs)
+    print 'projecting ctx every step : %.1f ms/video'%(1000 * durations.mean())
+    print 'cached ctx projection     : %.1f ms/video'%(1000 * durations_cached.mean())
+    print 'speedup %.2fx, identical samples: %s'%(durations.mean() / durations_cached.mean(),
+                                                  samples == samples_cached)
+    return durations, durations_cached
+
+def benchmark_batch_decoding(params, n_videos=100, batch_sizes=(1, 8, 32), checkpoint=None):
+    # beam search latency on the validation set with gen_sample against gen_sample_batch
+    engine, model, options, tfparams, use_noise = setup_model(params)
+    CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+        BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER = train.sampler_placeholders(
+            options['ctx_frames'], options['ctx_dim'], options['lstm_dim'])
+    CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, CTX_IDX_SAMPLER, PCTX_BATCH_SAMPLER = \
+        train.batch_sampler_placeholders(options['ctx_frames'], options['ctx_dim'])
+    states = [BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER]
+    f_init, f_next = model.build_sampler(tfparams, options, use_noise, CTX_SAMPLER, CTX_MASK_SAMPLER,
+                                         X_SAMPLER, *states, pctx_sampler=PCTX_SAMPLER)
+    f_init_batch, f_next_batch = model.build_batch_sampler(tfparams, options, use_noise, CTX_BATCH_SAMPLER,
+                                                           CTX_MASK_BATCH_SAMPLER, X_SAMPLER, CTX_IDX_SAMPLER,
+                                                           PCTX_BATCH_SAMPLER, *states)
+    ctxs, ctx_masks = engine.prepare_data_for_blue('val')
+    ctxs = np.asarray(ctxs[:n_videos])
+    ctx_masks = np.asarray(ctx_masks[:n_videos])
+    sess = start_session(tfparams, checkpoint)
+    time_gen_sample(sess, model, f_init, f_next, options, ctxs[:1], ctx_masks[:1])
+    samples, durations = time_gen_sample(sess, model, f_init, f_next, options, ctxs, ctx_masks)
+    print 'decoded %d validation videos with beam 5'%len(ctxs)
+    print 'gen_sample              : %.1f ms/video'%(1000 * durations.mean())
+    for batch_size in batch_sizes:
+        model.gen_sample_batch(sess, f_init_batch, f_next_batch, ctxs[:batch_size], ctx_masks[:batch_size],
+                               options, k=5)
+        samples_batch = []
+        t0 = time.time()
+        for i in xrange(0, len(ctxs), batch_size):
+            rval = model.gen_sample_batch(sess, f_init_batch, f_next_batch, ctxs[i:i+batch_size],
+                                          ctx_masks[i:i+batch_size], options, k=5)
+            samples_batch += [sample[np.argmin(score)] for sample, score in rval]
+        duration = (time.time() - t0) / len(ctxs)
+        print 'gen_sample_batch of %3d : %.1f ms/video, speedup %.2fx, %d/%d identical samples'%(
+            batch_size, 1000 * duration, durations.mean() / duration,
+            np.sum([a == b for a, b in zip(samples, samples_batch)]), len(ctxs))
+    sess.close()
+
+def benchmark_restricted_voc(params, n_videos=100, n_frequents=(250, 500, 1000, 2000), n_neighbors=5,
+                             checkpoint=None):
+    # gen_sample latency and BLEU-4 on the validation set over every word against shortlists
+    engine, model, options, tfparams, use_noise = setup_model(params)
+    CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+        BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER = train.sampler_placeholders(
+            options['ctx_frames'], options['ctx_dim'], options['lstm_dim'])
+    inputs = [CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER,
+              BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER]
+    f_init, f_next = model.build_sampler(tfparams, options, use_noise, *inputs, pctx_sampler=PCTX_SAMPLER)
+    f_init_voc, f_next_voc = model.build_sampler(tfparams, options, use_noise, *inputs, pctx_sampler=PCTX_SAMPLER,
+                                                 voc_sampler=train.voc_sampler_placeholder(options['vocab_size']))
+    vid_ids, ctxs, ctx_masks = zip(*itertools.islice(engine.iterate_data_for_blue('val'), n_videos))
+    scorer = FastScorer(metrics.get_reference_cache(engine, 'val').GT, vid_ids)
+    def bleu(samples):
+        return scorer.score(metrics.build_sample_pairs(metrics.seqs2words(samples, engine), vid_ids))['Bleu_4']
+    sess = start_session(tfparams, checkpoint)
+    time_gen_sample(sess, model, f_init, f_next, options, ctxs[:1], ctx_masks[:1])
+    samples, durations = time_gen_sample(sess, model, f_init, f_next, options, ctxs, ctx_masks)
+    full_bleu = bleu(samples)
+    print 'decoded %d validation videos with beam 5'%len(ctxs)
+    print 'every word (%5d)             : %.1f ms/video, BLEU-4 %.4f'%(
+        options['vocab_size'], 1000 * durations.mean(), full_bleu)
+    for n_frequent in n_frequents:
+        engine.build_shortlists(n_frequent, n_neighbors)
+        restrict_vocs = [engine.get_shortlist(ctx, ctx_mask) for ctx, ctx_mask in zip(ctxs, ctx_masks)]
+        time_gen_sample(sess, model, f_init_voc, f_next_voc, options, ctxs[:1], ctx_masks[:1],
+                        restrict_vocs=restrict_vocs[:1])
+        samples_voc, durations_voc = time_gen_sample(sess, model, f_init_voc, f_next_voc, options,
+                                                     ctxs, ctx_masks, restrict_vocs=restrict_vocs)
+        voc_bleu = bleu(samples_voc)
+        print '%4d frequent + %d neighbors (%5d) : %.1f ms/video, speedup %.2fx, BLEU-4 %.4f (%+.4f), %d/%d identical samples'%(
+            n_frequent, n_neighbors, np.mean([len(voc) for voc in restrict_vocs]), 1000 * durations_voc.mean(),
+            durations.mean() / durations_voc.mean(), voc_bleu, voc_bleu - full_bleu,
+            np.sum([a == b for a, b in zip(samples, samples_voc)]), len(ctxs))
+    sess.close()
+
+def list_beam_step(hyp_samples, hyp_scores, next_p, next_state, k, dead_k):
+    # host side of a beam step as gen_sample did it with lists and a full argsort, for comparison
+    cand_flat = (hyp_scores[:, None] - np.log(next_p)).flatten()
+    ranks_flat = cand_flat.argsort()[:(k - dead_k)]
+    voc_size = next_p.shape[1]
+    trans_indices = ranks_flat / voc_size
+    word_indices = ranks_flat % voc_size
+    costs = cand_flat[ranks_flat]
+    new_hyp_samples = []
+    new_hyp_scores = np.zeros(k - dead_k).astype('float32')
+    new_hyp_states = [[] for _ in next_state]
+    for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+        new_hyp_samples.append(hyp_samples[ti] + [wi])
+        new_hyp_scores[idx] = copy.copy(costs[idx])
+        for lidx in xrange(len(next_state)):
+            new_hyp_states[lidx].append(copy.copy(next_state[lidx][ti]))
+    return new_hyp_samples, new_hyp_scores, [np.array(states) for states in new_hyp_states]
+
+def vectorized_beam_step(hyp_samples, hyp_scores, next_p, next_state, k, dead_k, ii):
+    # the same step with beam_candidates and fancy indexing, as gen_sample does it now
+    trans_indices, word_indices, costs = beam_candidates(hyp_scores, next_p, k - dead_k)
+    new_hyp_samples = hyp_samples[trans_indices]
+    new_hyp_samples[:, ii] = word_indices
+    return new_hyp_samples, costs, [state[trans_indices] for state in next_state]
+
+def benchmark_beam_bookkeeping(params, k=5, n_steps=1000, length=10, maxlen=30, seed=1234):
+    # host time of one beam step on synthetic word probabilities over the configured vocabulary,
+    # no model or session involved
+    vocab_size = params['vocab_size']
+    rng = np.random.RandomState(seed)
+    next_p = np.exp(3 * rng.randn(k, vocab_size)).astype('float32')
+    next_p /= next_p.sum(axis=1, keepdims=True)
+    next_state = [rng.randn(k, params['lstm_dim']).astype('float32') for _ in xrange(4)]
+    hyp_scores = rng.rand(k).astype('float32')
+    hyp_samples = np.zeros((k, maxlen), dtype='int32')
+    hyp_samples[:, :length] = rng.randint(1, vocab_size, size=(k, length))
+    hyp_samples_list = [list(seq[:length]) for seq in hyp_samples]
+
+    t0 = time.time()
+    for _ in xrange(n_steps):
+        samples_list, scores_list, _ = list_beam_step(hyp_samples_list, hyp_scores, next_p, next_state, k, 0)
+    duration_list = (time.time() - t0) / n_steps
+    t0 = time.time()
+    for _ in xrange(n_steps):
+        samples, scores, _ = vectorized_beam_step(hyp_samples, hyp_scores, next_p, next_state, k, 0, length)
+    duration = (time.time() - t0) / n_steps
+
+    print 'beam %d over %d words, %d steps'%(k, vocab_size, n_steps)
+    print 'lists and argsort           : %.1f us/step'%(1e6 * duration_list)
+    print 'argpartition and gathers    : %.1f us/step'%(1e6 * duration)
+    print 'speedup %.2fx, identical hypotheses: %s'%(duration_list / duration,
+        samples_list == [list(seq[:length + 1]) for seq in samples] and np.allclose(scores_list, scores))
+    return duration_list, duration
+
+if __name__ == '__main__':
+    params = utils.load_default_params()
+    params['feats_dir'] = params['feats_dir']+params['cnn_name']+"/"
+    benchmarks = {'pctx_cache': benchmark_pctx_cache,
+                  'batch_decoding': benchmark_batch_decoding,
+                  'beam_bookkeeping': benchmark_beam_bookkeeping,
+                  'restricted_voc': benchmark_restricted_voc}
+    benchmarks[sys.argv[1] if len(sys.argv) > 1 else 'pctx_cache'](params)
@@ -3,14 +3,154 @@ from coco.pycocoevalcap.rouge.rouge import Rouge
 from coco.pycocoevalcap.cider.cider import Cider
 from coco.pycocoevalcap.meteor.meteor import Meteor
 from coco.pycocoevalcap.tokenizer.ptbtokenizer import PTBTokenizer
+from coco.pycocoevalcap.bleu import bleu_scorer
+from coco.pycocoevalcap.cider import cider_scorer
+import numpy as np
+from multiprocessing import Pool, current_process
+from collections import OrderedDict
+import subprocess, threading, time
 
 # Source : https://github.com/tylin/coco-caption
 
+SCORERS = ['Bleu', 'METEOR', 'ROUGE_L', 'CIDEr']
+
+def get_scorer(name):
+    # scorer and the metric(s) it reports
+    if name == 'Bleu':
+        return Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]
+    elif name == 'METEOR':
+        return Meteor(), "METEOR"
+    elif name == 'ROUGE_L':
+        return Rouge(), "ROUGE_L"
+    elif name == 'CIDEr':
+        return Cider(), "CIDEr"
+    raise ValueError('unknown scorer %s'%name)
+
+def cached_bleu(crefs, res, IDs):
+    # Bleu(4).compute_score with the references already cooked
+    scorer = bleu_scorer.BleuScorer(n=4)
+    for ID, refs in zip(IDs, crefs):
+        scorer.crefs.append(refs)
+        scorer.ctest.append(bleu_scorer.cook_test(res[ID][0], refs))
+    return scorer.compute_score(option='closest', verbose=1)
+
+def cached_cider(crefs, document_frequency, res, IDs):
+    # Cider().compute_score with the references cooked and their document frequencies counted
+    scorer = cider_scorer.CiderScorer(n=4, sigma=6.0)
+    scorer.crefs = crefs
+    scorer.ctest = [cider_scorer.cook_test(res[ID][0]) for ID in IDs]
+    scorer.document_frequency = document_frequency
+    score = scorer.compute_cider()
+    return np.mean(np.array(score)), np.array(score)
+
+def compute_metric(name, gts, res, IDs=None, refs=None):
+    # the scorer is built here, in the pool worker: Meteor holds a JVM that cannot be pickled
+    # refs: what ReferenceCache prepared for this scorer, if anything
+    t0 = time.time()
+    scorer, method = get_scorer(name)
+    print 'computing %s score...'%(scorer.method())
+    if refs is not None and name == 'Bleu':
+        score, scores = cached_bleu(refs, res, IDs)
+    elif refs is not None and name == 'CIDEr':
+        score, scores = cached_cider(refs[0], refs[1], res, IDs)
+    else:
+        score, scores = scorer.compute_score(gts, res)
+    return name, method, score, scores, time.time() - t0
+
+class ScorerService(object):
+    '''
+    METEOR kept for all the validations of a run, owned by train.train or the evaluation
+    worker: Meteor() starts a JVM, seconds of startup when built per validation. The JVM
+    is started on first use, restarted if it fails and stopped by close. PTBTokenizer
+    still starts a JVM per call, its lexer reads ahead and cannot answer line by line.
+    '''
+    def __init__(self, max_restarts=3):
+        self.meteor = None
+        self.max_restarts = max_restarts
+        self.n_restarts = 0
+
+    def get_meteor(self):
+        if self.meteor is None:
+            print 'starting METEOR...'
+            self.meteor = Meteor()
+        return self.meteor
+
+    def stop_meteor(self):
+        # never blocks on meteor.lock: Meteor.compute_score does not release it when it fails
+        if self.meteor is None:
+            return
+        meteor, self.meteor = self.meteor, None
+        meteor.lock.acquire(False)
+        try:
+            meteor.meteor_p.stdin.close()
+        except IOError:
+            # broken pipe
+            pass
+        meteor.meteor_p.kill()
+        meteor.meteor_p.wait()
+        # Meteor.__del__ kills it again, not a reaped pid that may be another process's by then
+        meteor.meteor_p.kill = lambda: None
+        meteor.lock.release()
+
+    def method(self):
+        return "METEOR"
+
+    def compute_score(self, gts, res):
+        # Meteor().compute_score on the running JVM, restarting it up to max_restarts times
+        # per call if it broke, n_restarts counts them over the run
+        n_failures = 0
+        while True:
+            try:
+                return self.get_meteor().compute_score(gts, res)
+            except (IOError, OSError, ValueError) as e:
+                self.stop_meteor()
+                if n_failures >= self.max_restarts:
+                    raise
+                n_failures += 1
+                self.n_restarts += 1
+                print 'METEOR failed (%s), restarting it'%e
+
+    def close(self):
+        self.stop_meteor()
+
+def compute_service_metric(service, name, gts, res):
+    # compute_metric for the scorers that the service keeps, in the process that owns it
+    assert name == 'METEOR'
+    t0 = time.time()
+    print 'computing METEOR score...'
+    score, scores = service.compute_score(gts, res)
+    return name, "METEOR", score, scores, time.time() - t0
+
+class ReferenceCache(object):
+    '''
+    The references of a split, prepared once for all the validations of a run: tokenized,
+    cooked into the n-gram counts of BLEU and CIDEr, with the CIDEr document frequencies.
+    COCOScorer.score then only processes the candidates.
+    '''
+    def __init__(self, GT, IDs):
+        self.GT = GT
+        self.IDs = list(IDs)
+        print 'tokenizing references...'
+        gts = PTBTokenizer().tokenize(dict((ID, GT[ID]) for ID in self.IDs))
+        self.gts = OrderedDict((ID, gts[ID]) for ID in self.IDs)
+        bleu_crefs = [bleu_scorer.cook_refs(self.gts[ID]) for ID in self.IDs]
+        cider = cider_scorer.CiderScorer(n=4, sigma=6.0)
+        cider.crefs = [cider_scorer.cook_refs(self.gts[ID]) for ID in self.IDs]
+        cider.compute_doc_freq()
+        self.refs = {'Bleu': bleu_crefs,
+                     'CIDEr': (cider.crefs, cider.document_frequency)}
+
 class COCOScorer(object):
-    def __init__(self):
+    def __init__(self, parallel=True, service=None):
+        # parallel: run the scorers concurrently, one process each
+        # service: ScorerService computing METEOR here, the other scorers still go to the pool
         print 'init COCO-EVAL scorer'
+        self.parallel = parallel
+        self.service = service
+        self.timing = OrderedDict()
             
-    def score(self, GT, RES, IDs):
+    def score(self, GT, RES, IDs, ref_cache=None):
+        # ref_cache: ReferenceCache of GT and IDs, only the candidates are tokenized then
         self.eval = {}
         self.imgToEval = {}
         gts = {}
@@ -19,28 +159,47 @@ class COCOScorer(object):
             gts[ID] = GT[ID]
             res[ID] = RES[ID]
         print 'tokenization...'
-        tokenizer = PTBTokenizer()
-        gts  = tokenizer.tokenize(gts)
-        res = tokenizer.tokenize(res)
-
-        # =================================================
-        # Set up scorers
-        # =================================================
-        print 'setting up scorers...'
-        scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-            (Meteor(),"METEOR"),
-            (Rouge(), "ROUGE_L"),
-            (Cider(), "CIDEr")
-        ]
+        t0 = time.time()
+        if ref_cache is not None:
+            assert list(IDs) == ref_cache.IDs
+            gts = ref_cache.gts
+            res = PTBTokenizer().tokenize(res)
+            # in the order of IDs, as the references
+            res = OrderedDict((ID, res[ID]) for ID in IDs)
+        else:
+            # one tokenizer JVM for both
+            tokenized = PTBTokenizer().tokenize(dict([(('gts', ID), caps) for ID, caps in gts.items()] +
+                                                     [(('res', ID), caps) for ID, caps in res.items()]))
+            gts = dict((ID, tokenized[('gts', ID)]) for ID in gts)
+            res = dict((ID, tokenized[('res', ID)]) for ID in res)
+        self.timing = OrderedDict([('tokenization', time.time() - t0)])
 
         # =================================================
         # Compute scores
         # =================================================
-        eval = {}
-        for scorer, method in scorers:
-            print 'computing %s score...'%(scorer.method())
-            score, scores = scorer.compute_score(gts, res)
+        print 'setting up scorers...'
+        t0 = time.time()
+        refs = ref_cache.refs if ref_cache is not None else {}
+        local = ['METEOR'] if self.service is not None else []
+        pooled = [name for name in SCORERS if name not in local]
+        # daemonic processes, such as the evaluation worker, cannot start a pool
+        if self.parallel and not current_process().daemon:
+            pool = Pool(len(pooled))
+            try:
+                pending = [pool.apply_async(compute_metric, (name, gts, res, IDs, refs.get(name)))
+                           for name in pooled]
+                # METEOR runs here while the pool works
+                results = [compute_service_metric(self.service, name, gts, res) for name in local]
+                results += [result.get() for result in pending]
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [compute_service_metric(self.service, name, gts, res) for name in local]
+            results += [compute_metric(name, gts, res, IDs, refs.get(name)) for name in pooled]
+        results.sort(key=lambda result: SCORERS.index(result[0]))
+        for name, method, score, scores, duration in results:
+            self.timing[name] = duration
             if type(method) == list:
                 for sc, scs, m in zip(score, scores, method):
                     self.setEval(sc, m)
@@ -50,7 +209,10 @@ class COCOScorer(object):
                 self.setEval(score, method)
                 self.setImgToEvalImgs(scores, IDs, method)
                 print "%s: %0.3f"%(method, score)
-                
+        self.timing['scoring'] = time.time() - t0
+
+        print 'timing: ' + ', '.join('%s %.2f sec'%(name, duration)
+                                     for name, duration in self.timing.items())
         for metric, score in self.eval.items():
             print '%s: %.3f'%(metric, score)
         return self.eval
@@ -65,11 +227,12 @@ class COCOScorer(object):
                 self.imgToEval[imgId]["image_id"] = imgId
             self.imgToEval[imgId][method] = score
 
-def score(ref, sample):
+def score(ref, sample, service=None):
     # ref and sample are both dict
+    # service: ScorerService, its running METEOR is used instead of starting one
     scorers = [
         (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-        (Meteor(),"METEOR"),
+        (service if service is not None else Meteor(),"METEOR"),
         (Rouge(), "ROUGE_L"),
         (Cider(), "CIDEr")
     ]
@@ -126,5 +289,60 @@ def test_cocoscorer():
     scorer = COCOScorer()
     scorer.score(gts, samples, IDs)
     
+class FlakyMeteor(object):
+    # Meteor on a cat process whose calls in failing fail like a bad reply does, lock held
+    n_started = 0
+    n_calls = 0
+    failing = set()
+    def __init__(self):
+        self.meteor_p = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        FlakyMeteor.n_started += 1
+
+    def compute_score(self, gts, res):
+        self.lock.acquire()
+        FlakyMeteor.n_calls += 1
+        if FlakyMeteor.n_calls - 1 in FlakyMeteor.failing:
+            float('')
+        self.lock.release()
+        return 0.5, [0.5] * len(res)
+
+    def __del__(self):
+        self.lock.acquire()
+        self.meteor_p.stdin.close()
+        self.meteor_p.kill()
+        self.meteor_p.wait()
+        self.lock.release()
+
+def test_scorer_service():
+    # the service restarts a METEOR that failed with its lock held instead of hanging,
+    # max_restarts times per call however many failed before
+    global Meteor
+    coco_meteor, Meteor = Meteor, FlakyMeteor
+    gts, res = {'a': ['x'], 'b': ['y']}, {'a': ['x'], 'b': ['z']}
+    try:
+        FlakyMeteor.failing = set([0, 2, 4, 6, 7])
+        service = ScorerService(max_restarts=1)
+        first = service.get_meteor()
+        for call in range(3):
+            score, scores = service.compute_score(gts, res)
+            assert (score, scores) == (0.5, [0.5, 0.5])
+        assert service.n_restarts == 3 and FlakyMeteor.n_started == 4
+        assert first.meteor_p.returncode is not None
+        del first
+        try:
+            service.compute_score(gts, res)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('failed more than max_restarts times in a call and went on')
+        assert service.compute_score(gts, res)[0] == 0.5
+        service.close()
+        assert service.meteor is None
+    finally:
+        Meteor = coco_meteor
+    print 'scorer service restarts'
+
 if __name__ == '__main__':
+    test_scorer_service()
     test_cocoscorer()
@@ -115,6 +115,19 @@ params = {
     'ctx_frames' : 28, # 26 when compare 
     'random_seed' : 1234,
     'beam_search' : True,
+    'use_feats_store' : False,  # read features from one packed memory-mapped array instead of per-video .npy
+    'prefetch_depth' : 0,   # minibatches assembled ahead of the train loop, 0 to disable
+    'prefetch_workers' : 1,
+    'n_length_buckets' : 0, # minibatch captions of similar length together, 0 for plain chunking
+    'caps_per_video' : 0,   # minibatches of videos x caps_per_video captions sharing one context, 0 to disable
+    'decode_batch_size' : 1,    # videos beam searched together in validation, 1 to decode one at a time
+    'graph_beam_search' : False,    # beam search inside the graph with tf.while_loop, one sess.run per batch of videos
+    'async_eval' : False,   # validate checkpoints in a separate process while training goes on
+    'decode_processes' : 0, # CPU processes beam searching validation, 0 to decode in the training session
+    'fast_scoring' : False, # validate with fast_scorer, no METEOR, the best model gets the full COCO scores at the end
+    'restrict_voc' : 0, # decode over this many most frequent words plus those of similar training videos, 0 for every word
+    'restrict_voc_neighbors' : 5,   # similar training videos whose caption words restrict_voc adds
+    'softmax_samples' : 0,  # train with a sampled softmax over this many words drawn by frequency, 0 for the full softmax
 }
 
 # params = {
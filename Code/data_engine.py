@@ -1,13 +1,20 @@
+import os
 import time
+import sys
+import threading
+import Queue
 import numpy as np
 import utils, config
+import feature_store
 from collections import OrderedDict
 
 class Movie2Caption(object):
             
     def __init__(self, dataset_name,cnn_name,train_data_ids_path, val_data_ids_path, test_data_ids_path,
                 vocab_path, reverse_vocab_path, mb_size_train, mb_size_test, maxlen_caption,
-                train_caps_path, val_caps_path, test_caps_path, feats_dir):
+                train_caps_path, val_caps_path, test_caps_path, feats_dir,
+                use_feats_store=False, ctx_frames=config.FRAME_SPACING, n_length_buckets=0,
+                caps_per_video=0):
         self.dataset_name = dataset_name 
         self.cnn_name = cnn_name
         self.train_data_ids_path = train_data_ids_path
@@ -22,15 +29,72 @@ class Movie2Caption(object):
         self.val_caps_path = val_caps_path
         self.test_caps_path = test_caps_path
         self.feats_dir = feats_dir
+        self.use_feats_store = use_feats_store
+        self.ctx_frames = ctx_frames
+        self.n_length_buckets = n_length_buckets
+        self.caps_per_video = caps_per_video
+        self.shortlists = None  # candidate vocabularies of restricted decoding, see build_shortlists
+        self.ref_cache = {} # references of val/test prepared for scoring by (whichset, scoring), see metrics.get_reference_cache
         self.load_data()
     
     def get_video_features(self, vid_id):
         if self.cnn_name in ['ResNet50', 'ResNet152', 'InceptionV3', 'VGG19', 'MURALI']:
+            if self.use_feats_store:
+                return self.feats_store[self.feats_store_index[vid_id]]
             feat = np.load(self.feats_dir+vid_id+'.npy')
         else:
             raise NotImplementedError()
         return feat.astype('float32')
 
+    def get_batch_features(self, vid_ids):
+        # (m, n_frames, ctx_dim) features for a minibatch of videos
+        if self.use_feats_store:
+            rows = np.asarray([self.feats_store_index[vid_id] for vid_id in vid_ids], dtype='int64')
+            return self.feats_store[rows]   # one gather from the memory-mapped store
+        return np.asarray([self.get_video_features(vid_id) for vid_id in vid_ids], dtype='float32')
+
+    def get_caps_features(self, rows, mode):
+        # (m, n_frames, ctx_dim) features for rows of the encoded captions of mode
+        enc = self.encoded_caps[mode]
+        if self.use_feats_store:
+            return self.feats_store[enc['store_rows'][rows]]
+        return self.get_batch_features([enc['vid_ids'][i] for i in enc['vid_idx'][rows]])
+
+    def load_feats_store(self):
+        # pack every video of the splits, not only the ones currently in use
+        vid_ids = OrderedDict()
+        for enc in self.encoded_caps.values():
+            for vid_id in enc['vid_ids']:
+                vid_ids[vid_id] = None
+        self.feats_store, self.feats_store_index = feature_store.get_feature_store(
+            self.feats_dir, vid_ids.keys(), self.ctx_frames, self.ctx_dim)
+        for enc in self.encoded_caps.values():
+            vid_rows = np.asarray([self.feats_store_index[vid_id] for vid_id in enc['vid_ids']], dtype='int64')
+            enc['store_rows'] = vid_rows[enc['vid_idx']]
+
+    def load_encoded_caps(self, data_ids_path, caps_path, data_ids, vid_caps):
+        '''
+        Encoded captions of data_ids (in file order), cached next to data_ids_path.
+        The cache is rebuilt when it is older than its sources or was built for
+        other ids or another vocabulary size.
+        '''
+        cache_path = os.path.splitext(data_ids_path)[0]+'_encoded.npz'
+        enc = None
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= max(
+                os.path.getmtime(path) for path in [data_ids_path, caps_path, self.vocab_path]):
+            cache = np.load(cache_path)
+            if int(cache['vocab_size']) == self.vocab_size and cache['data_ids'].tolist() == data_ids:
+                enc = dict((key, cache[key]) for key in ['tokens', 'offsets', 'lengths', 'vid_idx'])
+                enc['vid_ids'] = cache['vid_ids'].tolist()
+        if enc is None:
+            print 'encoding captions of %s into %s'%(data_ids_path, cache_path)
+            enc = encode_captions(data_ids, vid_caps, self.vocab, self.vocab_size)
+            np.savez(cache_path, data_ids=np.asarray(data_ids), vid_ids=np.asarray(enc['vid_ids']),
+                     vocab_size=self.vocab_size, tokens=enc['tokens'], offsets=enc['offsets'],
+                     lengths=enc['lengths'], vid_idx=enc['vid_idx'])
+        enc['cap_row'] = dict((ID, row) for row, ID in enumerate(data_ids))
+        return enc
+
     def get_cap_tokens(self, vid_id, cap_id, mode):
         if mode == "train":
             vid_caps = self.train_caps
@@ -42,23 +106,77 @@ class Movie2Caption(object):
             raise NotImplementedError()
         return vid_caps[vid_id][cap_id]
 
-    def prepare_data_for_blue(self, whichset):
+    def iterate_data_for_blue(self, whichset, batch_size=None):
+        '''
+        Yield (vid_id, ctx, ctx_mask) for the videos of whichset one at a time, or
+        (vid_ids, ctxs, ctx_masks) for batch_size videos at a time, loading the features
+        on demand: memory stays at one batch whatever the size of the split.
+        '''
         # assume one-to-one mapping between ids and features
-        feats = []
-        feats_mask = []
         if whichset == 'val':
             ids = self.val_ids
         elif whichset == 'test':
             ids = self.test_ids
         elif whichset == 'train':
             ids = self.train_ids
-        for i, vidID in enumerate(ids):
-            feat = self.get_video_features(vidID)
+        if batch_size is None:
+            for vidID in ids:
+                feat = self.get_video_features(vidID)
+                yield vidID, feat, self.get_ctx_mask(feat)
+        else:
+            for i in xrange(0, len(ids), batch_size):
+                feats = self.get_batch_features(ids[i:i+batch_size])
+                yield ids[i:i+batch_size], feats, self.get_ctx_mask(feats)
+
+    def prepare_data_for_blue(self, whichset):
+        # all the features of whichset at once, see iterate_data_for_blue to stream them
+        feats = []
+        feats_mask = []
+        for vidID, feat, feat_mask in self.iterate_data_for_blue(whichset):
             feats.append(feat)
-            feat_mask = self.get_ctx_mask(feat)
             feats_mask.append(feat_mask)
         return feats, feats_mask
 
+    def get_word_counts(self):
+        # occurrences of every word in the training captions, <eos> once per caption
+        enc = self.encoded_caps['train']
+        counts = np.bincount(enc['tokens'], minlength=self.vocab_size)
+        counts[0] += len(enc['lengths'])
+        return counts
+
+    def build_shortlists(self, n_frequent, n_neighbors=5, batch_size=64):
+        '''
+        What get_shortlist draws from: the n_frequent most frequent words of the training
+        captions, the L2 normalized mean features of the training videos and the words of
+        the captions of each of them.
+        '''
+        enc = self.encoded_caps['train']
+        counts = self.get_word_counts()
+        counts[0] = counts.max() + 1  # <eos> in any case
+        frequent = np.sort(np.argsort(-counts, kind='mergesort')[:n_frequent])
+        # unique (video, word) pairs of the training captions
+        token_vids = np.repeat(enc['vid_idx'], enc['lengths'])
+        pairs = np.unique(token_vids * self.vocab_size + enc['tokens'])
+        bounds = np.searchsorted(pairs // self.vocab_size, np.arange(len(enc['vid_ids']) + 1))
+        words = [pairs[bounds[i]:bounds[i+1]] % self.vocab_size for i in xrange(len(enc['vid_ids']))]
+        feats = np.zeros((len(enc['vid_ids']), self.ctx_dim), dtype='float32')
+        for i in xrange(0, len(enc['vid_ids']), batch_size):
+            ctx = self.get_batch_features(enc['vid_ids'][i:i+batch_size])
+            feats[i:i+batch_size] = ctx.sum(axis=1) / np.maximum(self.get_ctx_mask(ctx).sum(axis=1), 1)[:, None]
+        feats /= np.maximum(np.linalg.norm(feats, axis=1), 1e-8)[:, None]
+        self.shortlists = {'frequent': frequent.astype('int32'), 'feats': feats, 'words': words,
+                           'n_neighbors': n_neighbors}
+
+    def get_shortlist(self, ctx, ctx_mask):
+        # sorted word ids to decode the video of ctx over: the frequent words and the words
+        # of the training videos closest to its mean feature by cosine similarity
+        feat = ctx.sum(axis=0) / max(ctx_mask.sum(), 1)
+        sims = self.shortlists['feats'].dot(feat / max(np.linalg.norm(feat), 1e-8))
+        n_neighbors = min(self.shortlists['n_neighbors'], len(sims))
+        neighbors = np.argpartition(-sims, n_neighbors - 1)[:n_neighbors]
+        return reduce(np.union1d, [self.shortlists['words'][i] for i in neighbors],
+                      self.shortlists['frequent']).astype('int32')
+
     def get_ctx_mask(self, ctx):
         if ctx.ndim == 3:
             rval = (ctx[:,:,:self.ctx_dim].sum(axis=-1) != 0).astype('int32').astype('float32')
@@ -86,18 +204,25 @@ class Movie2Caption(object):
         self.train_data_ids = utils.read_file_to_list(self.train_data_ids_path)
         self.val_data_ids = utils.read_file_to_list(self.val_data_ids_path)
         self.test_data_ids = utils.read_file_to_list(self.test_data_ids_path)
-        utils.shuffle_array(self.train_data_ids)
-        utils.shuffle_array(self.val_data_ids)
-        utils.shuffle_array(self.test_data_ids)
-        self.train_data_ids = self.train_data_ids[:1]   # ONLY FOR DEBUG - REMOVE
-        self.val_data_ids = self.val_data_ids[:1]
-        self.test_data_ids = self.test_data_ids[:1]
         self.train_caps = utils.read_from_json(self.train_caps_path)
         self.val_caps = utils.read_from_json(self.val_caps_path)
         self.test_caps = utils.read_from_json(self.test_caps_path)
         self.vocab = utils.read_from_json(self.vocab_path)
         self.reverse_vocab = utils.read_from_pickle(self.reverse_vocab_path)
         self.vocab_size = len(self.vocab)
+        self.encoded_caps = OrderedDict()
+        self.encoded_caps['train'] = self.load_encoded_caps(self.train_data_ids_path, self.train_caps_path,
+                                                            self.train_data_ids, self.train_caps)
+        self.encoded_caps['val'] = self.load_encoded_caps(self.val_data_ids_path, self.val_caps_path,
+                                                          self.val_data_ids, self.val_caps)
+        self.encoded_caps['test'] = self.load_encoded_caps(self.test_data_ids_path, self.test_caps_path,
+                                                           self.test_data_ids, self.test_caps)
+        utils.shuffle_array(self.train_data_ids)
+        utils.shuffle_array(self.val_data_ids)
+        utils.shuffle_array(self.test_data_ids)
+        self.train_data_ids = self.train_data_ids[:1]   # ONLY FOR DEBUG - REMOVE
+        self.val_data_ids = self.val_data_ids[:1]
+        self.test_data_ids = self.test_data_ids[:1]
         if self.cnn_name in ['ResNet50', 'ResNet152', 'InceptionV3']:
             self.ctx_dim = 2048
         elif self.cnn_name in ['MURALI']:
@@ -109,49 +234,195 @@ class Movie2Caption(object):
         self.train_ids = self.get_vid_ids(self.train_data_ids)
         self.val_ids = self.get_vid_ids(self.val_data_ids)
         self.test_ids = self.get_vid_ids(self.test_data_ids)
-        self.kf_train = utils.generate_minibatch_idx(len(self.train_data_ids), self.mb_size_train)
-        self.kf_val = utils.generate_minibatch_idx(len(self.val_data_ids), self.mb_size_test)   #TODO - verify test or val
-        self.kf_test = utils.generate_minibatch_idx(len(self.test_data_ids), self.mb_size_test)
+        if self.use_feats_store:
+            self.load_feats_store()
+        if self.n_length_buckets > 0:
+            self.train_caps_lengths = self.get_caps_lengths(self.train_data_ids, "train")
+            self.val_caps_lengths = self.get_caps_lengths(self.val_data_ids, "val")
+            self.test_caps_lengths = self.get_caps_lengths(self.test_data_ids, "test")
+            self.shuffle_train_minibatches()
+            self.kf_val = utils.generate_bucketed_minibatch_idx(self.val_caps_lengths, self.mb_size_test, self.n_length_buckets)
+            self.kf_test = utils.generate_bucketed_minibatch_idx(self.test_caps_lengths, self.mb_size_test, self.n_length_buckets)
+            chunked_padding = utils.count_padding(
+                utils.generate_minibatch_idx(len(self.train_data_ids), self.mb_size_train), self.train_caps_lengths)
+            bucketed_padding = utils.count_padding(self.kf_train, self.train_caps_lengths)
+            print('length bucketing: %d padded timesteps per train epoch instead of %d (%.1f%% removed)'%(
+                bucketed_padding, chunked_padding, 100. * (chunked_padding - bucketed_padding) / max(chunked_padding, 1)))
+        else:
+            self.kf_train = utils.generate_minibatch_idx(len(self.train_data_ids), self.mb_size_train)
+            self.kf_val = utils.generate_minibatch_idx(len(self.val_data_ids), self.mb_size_test)   #TODO - verify test or val
+            self.kf_test = utils.generate_minibatch_idx(len(self.test_data_ids), self.mb_size_test)
+        if self.caps_per_video > 0:
+            enc = self.encoded_caps['train']
+            self.train_caps_vid_idx = enc['vid_idx'][[enc['cap_row'][ID] for ID in self.train_data_ids]]
+            self.shuffle_train_minibatches()
+
+    def get_caps_lengths(self, data_ids, mode):
+        enc = self.encoded_caps[mode]
+        return enc['lengths'][[enc['cap_row'][ID] for ID in data_ids]]
+
+    def shuffle_train_minibatches(self):
+        # with caption grouping or length bucketing, draw a new set of minibatches for the next epoch
+        if self.caps_per_video > 0:
+            self.kf_train = utils.generate_grouped_minibatch_idx(self.train_caps_vid_idx, self.mb_size_train,
+                                                                 self.caps_per_video)
+        elif self.n_length_buckets > 0:
+            self.kf_train = utils.generate_bucketed_minibatch_idx(self.train_caps_lengths, self.mb_size_train,
+                                                                  self.n_length_buckets)
         
-def prepare_data(engine, IDs, mode="train"):
-    seqs = []
-    feat_list = []
-    for i, ID in enumerate(IDs):
-        #print 'processed %d/%d caps'%(i,len(IDs))
+def engine_from_options(options):
+    # Movie2Caption for a model_options/config.params dict, as train.train builds it
+    return Movie2Caption(options['dataset_name'], options['cnn_name'], options['train_data_ids_path'],
+                options['val_data_ids_path'], options['test_data_ids_path'],
+                options['vocab_path'], options['reverse_vocab_path'], options['mb_size_train'],
+                options['mb_size_test'], options['maxlen_caption'],
+                options['train_caps_path'], options['val_caps_path'], options['test_caps_path'],
+                options['feats_dir'], use_feats_store=options.get('use_feats_store', False),
+                ctx_frames=options['ctx_frames'], n_length_buckets=options.get('n_length_buckets', 0),
+                caps_per_video=options.get('caps_per_video', 0))
+
+def encode_captions(data_ids, vid_caps, vocab, vocab_size):
+    # flat int32 token array with per-caption offsets/lengths and video indices into vid_ids
+    vid_rows = OrderedDict()
+    tokens = []
+    offsets = []
+    lengths = []
+    vid_idx = []
+    for ID in data_ids:
         vidID, capID = ID.split('|')
-        feat = engine.get_video_features(vidID)
-        feat_list.append(feat)
-        words = engine.get_cap_tokens(vidID, int(capID), mode)
-        seqs.append([engine.vocab[w]
-                     if w in engine.vocab and engine.vocab[w] < engine.vocab_size else 1 for w in words])   # 1 => UNK
-    lengths = [len(s) for s in seqs]
+        words = vid_caps[vidID][int(capID)]
+        offsets.append(len(tokens))
+        lengths.append(len(words))
+        tokens.extend([vocab[w]
+                       if w in vocab and vocab[w] < vocab_size else 1 for w in words])   # 1 => UNK
+        vid_idx.append(vid_rows.setdefault(vidID, len(vid_rows)))
+    return {'tokens': np.asarray(tokens, dtype='int32'),
+            'offsets': np.asarray(offsets, dtype='int64'),
+            'lengths': np.asarray(lengths, dtype='int32'),
+            'vid_idx': np.asarray(vid_idx, dtype='int64'),
+            'vid_ids': vid_rows.keys()}
+
+def prepare_caps(engine, IDs, mode="train"):
+    # returns encoded caption rows of IDs shorter than maxlen_caption with their (x, x_mask)
+    enc = engine.encoded_caps[mode]
+    rows = np.asarray([enc['cap_row'][ID] for ID in IDs], dtype='int64')
+    lengths = enc['lengths'][rows]
     if engine.maxlen_caption != None:
-        new_seqs = []
-        new_feat_list = []
-        new_lengths = []
-        new_caps = []
-        for l, s, y, c in zip(lengths, seqs, feat_list, IDs):
-            # sequences that have length >= maxlen_caption will be thrown away 
-            if l < engine.maxlen_caption:
-                new_seqs.append(s)
-                new_feat_list.append(y)
-                new_lengths.append(l)
-                new_caps.append(c)
-        lengths = new_lengths
-        feat_list = new_feat_list
-        seqs = new_seqs
-        if len(lengths) < 1:
-            return None, None, None, None
-    y = np.asarray(feat_list, dtype='float32')   # shape (batch_size,n_frames=28,ctx_dim=2048)
-    y_mask = engine.get_ctx_mask(y)
-    n_samples = len(seqs)
+        # sequences that have length >= maxlen_caption will be thrown away 
+        keep = lengths < engine.maxlen_caption
+        rows = rows[keep]
+        lengths = lengths[keep]
+        if len(rows) < 1:
+            return None, None, None
     maxlen = np.max(lengths)+1
-    x = np.zeros((maxlen, n_samples)).astype('int32')   # storing captions coloumn-wise , shape (max_seq_len,batch_size)
-    x_mask = np.zeros((maxlen, n_samples)).astype('float32')
-    for idx, s in enumerate(seqs):
-        x[:lengths[idx],idx] = s
-        x_mask[:lengths[idx]+1,idx] = 1.
+    steps = np.arange(maxlen)[:, None]
+    # storing captions coloumn-wise , shape (max_seq_len,batch_size)
+    positions = np.minimum(enc['offsets'][rows][None, :] + steps, len(enc['tokens']) - 1)
+    x = np.where(steps < lengths[None, :], enc['tokens'][positions], 0).astype('int32')
+    x_mask = (steps <= lengths[None, :]).astype('float32')
+    return rows, x, x_mask
+
+def prepare_data(engine, IDs, mode="train"):
+    rows, x, x_mask = prepare_caps(engine, IDs, mode)
+    if rows is None:
+        return None, None, None, None
+    y = engine.get_caps_features(rows, mode)   # shape (batch_size,n_frames=28,ctx_dim=2048)
+    y_mask = engine.get_ctx_mask(y)
     return x, x_mask, y, y_mask
+
+def prepare_data_grouped(engine, IDs, mode="train"):
+    # like prepare_data, but with the features of each video only once:
+    # y (n_videos,n_frames,ctx_dim) and y_idx (batch_size,) the row of y of every caption
+    rows, x, x_mask = prepare_caps(engine, IDs, mode)
+    if rows is None:
+        return None, None, None, None, None
+    _, first, y_idx = np.unique(engine.encoded_caps[mode]['vid_idx'][rows], return_index=True, return_inverse=True)
+    y = engine.get_caps_features(rows[first], mode)
+    y_mask = engine.get_ctx_mask(y)
+    return x, x_mask, y, y_mask, y_idx.astype('int32')
+
+class BatchPrefetcher(object):
+    '''
+    Assemble the minibatches of kf with prepare_data on n_workers threads, ahead of
+    the consumer. At most depth minibatches are assembled or waiting at any time
+    and they are yielded in the order of kf as (tags, (x, x_mask, ctx, ctx_mask)).
+    '''
+    def __init__(self, engine, kf, data_ids, mode="train", depth=2, n_workers=1, prepare_fn=None):
+        assert depth > 0 and n_workers > 0
+        self.prepare_fn = prepare_data if prepare_fn is None else prepare_fn
+        self.engine = engine
+        self.kf = kf
+        self.data_ids = data_ids
+        self.mode = mode
+        self.depth = depth
+        self.n_workers = n_workers
+
+    def __iter__(self):
+        tasks = Queue.Queue()
+        for pos, idx in enumerate(self.kf):
+            tasks.put((pos, idx))
+        results = Queue.Queue()
+        slots = threading.Semaphore(self.depth)
+        stop = threading.Event()
+
+        def worker():
+            while True:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                try:
+                    pos, idx = tasks.get_nowait()
+                except Queue.Empty:
+                    slots.release()
+                    return
+                tags = [self.data_ids[index] for index in idx]
+                try:
+                    results.put((pos, tags, self.prepare_fn(self.engine, tags, self.mode), None))
+                except Exception:
+                    results.put((pos, tags, None, sys.exc_info()))
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in xrange(self.n_workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        pending = {}
+        try:
+            for pos in xrange(len(self.kf)):
+                while pos not in pending:
+                    item = results.get()
+                    pending[item[0]] = item[1:]
+                tags, batch, exc_info = pending.pop(pos)
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                slots.release()
+                yield tags, batch
+        finally:
+            stop.set()
+            for thread in threads:
+                slots.release()
+
+def iterate_minibatches(engine, kf, data_ids, mode="train", prefetch_depth=0, n_workers=1, prepare_fn=None):
+    '''
+    Yields (tags, (x, x_mask, ctx, ctx_mask), pd_duration) for every minibatch of kf,
+    pd_duration being how long the caller waited for it. With prefetch_depth > 0 the
+    minibatches are assembled in the background by a BatchPrefetcher. prepare_fn
+    (prepare_data by default) builds each minibatch from its tags.
+    '''
+    if prepare_fn is None:
+        prepare_fn = prepare_data
+    if prefetch_depth > 0:
+        batches = iter(BatchPrefetcher(engine, kf, data_ids, mode, prefetch_depth, n_workers, prepare_fn))
+    else:
+        batches = ((tags, prepare_fn(engine, tags, mode))
+                   for tags in ([data_ids[index] for index in idx] for idx in kf))
+    while True:
+        pd_start = time.time()
+        try:
+            tags, batch = next(batches)
+        except StopIteration:
+            return
+        yield tags, batch, time.time() - pd_start
     
 def test_data_engine():
     # from sklearn.cross_validation import KFold
@@ -184,6 +455,22 @@ def test_data_engine():
         if i == 10:
             break
     print('used time %.2f'%(time.time()-t))
+    i = 0
+    t = time.time()
+    for tags, (x, mask, ctx, ctx_mask), pd_duration in iterate_minibatches(engine, engine.kf_train,
+                                                engine.train_data_ids, "train", prefetch_depth=4, n_workers=2):
+        i += 1
+        print x.shape, ctx.shape
+        print('seen %d prefetched minibatches, waited %.2f '%(i,pd_duration))
+        if i == 10:
+            break
+    print('used time %.2f'%(time.time()-t))
+    # streaming the val features gives what prepare_data_for_blue holds all at once
+    ctxs, ctx_masks = engine.prepare_data_for_blue('val')
+    streamed = list(engine.iterate_data_for_blue('val', batch_size=3))
+    assert sum(len(vid_ids) for vid_ids, _, _ in streamed) == len(ctxs)
+    assert np.allclose(np.concatenate([batch for _, batch, _ in streamed]), np.asarray(ctxs))
+    assert np.allclose(np.concatenate([masks for _, _, masks in streamed]), np.asarray(ctx_masks))
 
 def test_data_engine_murali():
     # from sklearn.cross_validation import KFold
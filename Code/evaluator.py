@@ -0,0 +1,177 @@
+import glob, os, shutil, time, traceback
+from multiprocessing import Process, Queue
+import Queue as queue_lib
+import tensorflow as tf
+import numpy as np
+
+import utils
+import data_engine
+import metrics
+import train
+import cocoeval
+from model import Model
+
+def copy_checkpoint(src, dst):
+    # copy the files of checkpoint src (src.index, src.data-*, ...) to checkpoint dst
+    for path in glob.glob(src+'.*'):
+        shutil.copyfile(path, dst+path[len(src):])
+
+def remove_checkpoint(path):
+    for path in glob.glob(path+'.*'):
+        os.remove(path)
+
+def build_eval_graph(options):
+    '''
+    The parts of the graph of train.train needed to validate a checkpoint: f_log_probs and
+    the samplers, on placeholders of the same names and parameters of the same names.
+    '''
+    engine = data_engine.engine_from_options(options)
+    options = dict(options)
+    options['ctx_dim'] = engine.ctx_dim
+    options['vocab_size'] = engine.vocab_size
+    ctx_frames, ctx_dim, lstm_dim = options['ctx_frames'], options['ctx_dim'], options['lstm_dim']
+    model = Model()
+    tfparams = utils.init_tfparams(model.init_params(options))
+
+    X = tf.placeholder(tf.int32, shape=(None, None), name='word_seq_x')
+    MASK = tf.placeholder(tf.float32, shape=(None, None), name='word_seq_mask')
+    CTX = tf.placeholder(tf.float32, shape=(None, ctx_frames, ctx_dim), name='ctx')
+    CTX_MASK = tf.placeholder(tf.float32, shape=(None, ctx_frames), name='ctx_mask')
+    use_noise, COST, _ = model.build_model(tfparams, options, X, MASK, CTX, CTX_MASK,
+                                           word_counts=engine.get_word_counts())
+    f_log_probs = -COST
+
+    CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+        BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER = train.sampler_placeholders(ctx_frames, ctx_dim, lstm_dim)
+    states = [BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER]
+    samplers = {}
+    VOC_SAMPLER = train.voc_sampler_placeholder(options['vocab_size']) if options.get('restrict_voc', 0) > 0 else None
+    samplers['f_init'], samplers['f_next'] = model.build_sampler(tfparams, options, use_noise,
+                                CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, *states, pctx_sampler=PCTX_SAMPLER,
+                                voc_sampler=VOC_SAMPLER)
+    samplers['f_init_batch'], samplers['f_next_batch'], samplers['f_beam'] = None, None, None
+    decode_batch_size = options.get('decode_batch_size', 1)
+    graph_beam_search = options.get('graph_beam_search', False)
+    if decode_batch_size > 1 or graph_beam_search:
+        CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, CTX_IDX_SAMPLER, PCTX_BATCH_SAMPLER = \
+            train.batch_sampler_placeholders(ctx_frames, ctx_dim)
+    if decode_batch_size > 1:
+        samplers['f_init_batch'], samplers['f_next_batch'] = model.build_batch_sampler(tfparams, options, use_noise,
+                                CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, X_SAMPLER, CTX_IDX_SAMPLER,
+                                PCTX_BATCH_SAMPLER, *states)
+    if graph_beam_search:
+        samplers['f_beam'] = model.build_beam_search(tfparams, options, use_noise,
+                                CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, k=5)
+    return engine, model, options, tfparams, f_log_probs, samplers
+
+def evaluate(sess, engine, model, options, f_log_probs, samplers, save_dir, scorer_service=None):
+    # perplexity on val and the COCO metrics of the beam search samples on val and test
+    valid_err, valid_perp = -1, -1
+    if not options['debug']:
+        print 'validating...'
+        valid_err, valid_perp = model.pred_probs(sess, engine, 'val',
+                f_log_probs, verbose=options['verbose'])
+    scores = metrics.compute_score(sess=sess,
+        model_type='attention',
+        model_archive=None,
+        options=options,
+        engine=engine,
+        save_dir=save_dir,
+        beam=5, n_process=5,
+        whichset='both',
+        on_cpu=False,
+        metric=options['metric'],
+        one_time=True,
+        model=model,
+        decode_batch_size=options.get('decode_batch_size', 1),
+        scorer_service=scorer_service,
+        scoring='fast' if options.get('fast_scoring', False) else 'coco',
+        **samplers)
+    return valid_err, valid_perp, scores
+
+def eval_worker(options, save_dir, jobs, results):
+    '''
+    Evaluate the checkpoints put in jobs as (eidx, uidx, checkpoint) until None comes,
+    putting (eidx, uidx, checkpoint, valid_err, valid_perp, scores, seconds) in results.
+    Runs on the CPU so that the GPU is left to training.
+    '''
+    scorer_service = cocoeval.ScorerService()
+    try:
+        with tf.Graph().as_default():
+            engine, model, options, tfparams, f_log_probs, samplers = build_eval_graph(options)
+            saver = tf.train.Saver(var_list=tfparams.values())
+            with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.graph.finalize()
+                while True:
+                    job = jobs.get()
+                    if job is None:
+                        break
+                    eidx, uidx, checkpoint = job
+                    t0 = time.time()
+                    saver.restore(sess, checkpoint)
+                    valid_err, valid_perp, scores = evaluate(sess, engine, model, options,
+                                                             f_log_probs, samplers, save_dir,
+                                                             scorer_service=scorer_service)
+                    results.put((eidx, uidx, checkpoint, valid_err, valid_perp, scores, time.time() - t0))
+    except Exception:
+        results.put(traceback.format_exc())
+    finally:
+        scorer_service.close()
+
+class AsyncEvaluator(object):
+    '''
+    Validation off the training critical path: submit saves a checkpoint and queues it
+    for a worker process with its own sampler graph, poll returns the evaluations that
+    finished since the last call. At most max_pending checkpoints wait for the worker.
+    Create it before the training session: the worker must not inherit an initialized
+    CUDA context, and the snapshots have their own saver, never deleting a queued one.
+    '''
+    def __init__(self, options, save_dir, max_pending=2):
+        self.save_dir = save_dir
+        self.max_pending = max_pending
+        self.saver = tf.train.Saver(max_to_keep=None)
+        self.jobs = Queue()
+        self.results = Queue()
+        self.n_pending = 0
+        self.process = Process(target=eval_worker, args=(options, save_dir, self.jobs, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, sess, eidx, uidx):
+        '''
+        Queue the current parameters for evaluation, first waiting for the oldest ones while
+        max_pending are queued. Returns the evaluations waited for, as poll does.
+        '''
+        rval = []
+        while self.n_pending >= self.max_pending:
+            rval.append(self.get_result(block=True))
+        checkpoint = self.save_dir+'model_eval_%d.ckpt'%uidx
+        self.saver.save(sess, checkpoint, write_meta_graph=False, latest_filename='eval_checkpoint')
+        self.jobs.put((eidx, uidx, checkpoint))
+        self.n_pending += 1
+        return rval
+
+    def get_result(self, block):
+        result = self.results.get(block=block)
+        if isinstance(result, str):
+            raise RuntimeError('evaluation worker failed:\n'+result)
+        self.n_pending -= 1
+        return result
+
+    def poll(self, block=False):
+        # finished evaluations in the order of submission, all the pending ones if block
+        rval = []
+        while self.n_pending > 0:
+            try:
+                rval.append(self.get_result(block))
+            except queue_lib.Empty:
+                break
+        return rval
+
+    def close(self):
+        # wait for the pending evaluations and stop the worker
+        self.jobs.put(None)
+        rval = self.poll(block=True)
+        self.process.join()
+        return rval
@@ -0,0 +1,128 @@
+import hashlib, json, os, shutil, tempfile
+import numpy as np
+import utils
+
+def get_entry_path(feats_dir, vid):
+    # ../Data/MSVD/Features/ResNet152/ -> ../Data/MSVD/Features/ResNet152/manifest/<vid>.json
+    return feats_dir+'manifest/'+vid+'.json'
+
+def source_stats(paths):
+    # (size, mtime) of every source, cheap enough to compare on every run
+    return [[os.path.getsize(path), os.path.getmtime(path)] for path in paths]
+
+def source_checksum(paths):
+    md5 = hashlib.md5()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+def replace_file(path, write):
+    # write(f) to a file of this process renamed to path, readers never see it half written
+    tmp_path = '%s.%d.tmp'%(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.rename(tmp_path, path)
+
+def save_features(path, feats):
+    replace_file(path, lambda f: np.save(f, feats))
+
+def write_entry(feats_dir, vid, entry):
+    entry_path = get_entry_path(feats_dir, vid)
+    try:
+        os.makedirs(os.path.dirname(entry_path))
+    except OSError:
+        # made by another worker
+        if not os.path.isdir(os.path.dirname(entry_path)):
+            raise
+    replace_file(entry_path, lambda f: json.dump(entry, f, indent=4))
+
+def read_entry(feats_dir, vid):
+    # the manifest entry of vid, or None if it was never completed
+    entry_path = get_entry_path(feats_dir, vid)
+    if not os.path.exists(entry_path):
+        return None
+    return utils.read_from_json(entry_path)
+
+def make_entry(sources, settings, shape, n_frames=None, selected=None):
+    '''
+    Manifest entry of features of the given shape computed from the files sources with
+    settings (everything else they depend on), out of n_frames frames of which the
+    selected ones were used.
+    '''
+    return {
+        'sources': list(sources),
+        'stats': source_stats(sources),
+        'checksum': source_checksum(sources),
+        'settings': settings,
+        'n_frames': n_frames,
+        'selected': None if selected is None else [int(fid) for fid in selected],
+        'shape': list(shape),
+        'status': 'done',
+    }
+
+def is_fresh(feats_dir, vid, sources, settings):
+    # whether feats_dir+vid+'.npy' was completed from the current sources with settings
+    entry = read_entry(feats_dir, vid)
+    if entry is None or entry['status'] != 'done' or entry['settings'] != settings \
+            or entry['sources'] != list(sources) or not os.path.exists(feats_dir+vid+'.npy'):
+        return False
+    stats = source_stats(sources)
+    if entry['stats'] == stats:
+        return True
+    # touched sources are only stale if their content changed
+    if entry['checksum'] != source_checksum(sources):
+        return False
+    entry['stats'] = stats
+    write_entry(feats_dir, vid, entry)
+    return True
+
+def worker_share(items, worker_id=0, n_workers=1):
+    # the items of worker worker_id out of n_workers, disjoint and independent of what is done
+    return items[worker_id::n_workers]
+
+def stale_videos(feats_dir, vids, get_sources, settings, worker_id=0, n_workers=1):
+    # (vid, sources) of the videos of this worker whose features are missing or stale
+    rval = []
+    for vid in worker_share(vids, worker_id, n_workers):
+        sources = get_sources(vid)
+        if not is_fresh(feats_dir, vid, sources, settings):
+            rval.append((vid, sources))
+    print '%d of %d videos to process in %s'%(len(rval), len(worker_share(vids, worker_id, n_workers)), feats_dir)
+    return rval
+
+def test_manifest():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        feats_dir = tmp_dir+'/feats/'
+        utils.create_dir_if_not_exist(feats_dir)
+        vids = ['vid%d'%i for i in range(7)]
+        get_sources = lambda vid: [tmp_dir+'/'+vid+'.avi']
+        for vid in vids:
+            with open(get_sources(vid)[0], 'wb') as f:
+                f.write(vid)
+        settings = {'cnn': 'ResNet152', 'frame_spacing': 28}
+        shares = [[vid for vid, _ in stale_videos(feats_dir, vids, get_sources, settings, i, 3)] for i in range(3)]
+        assert sorted(sum(shares, [])) == vids
+        for vid in vids[:5]:
+            save_features(feats_dir+vid+'.npy', np.zeros((3, 4), dtype=np.float32))
+            write_entry(feats_dir, vid, make_entry(get_sources(vid), settings, (3, 4), 10, [0, 4, 8]))
+        assert [vid for vid, _ in stale_videos(feats_dir, vids, get_sources, settings)] == vids[5:]
+        # touched but unchanged, changed, output lost, other settings
+        os.utime(get_sources('vid0')[0], (0, 0))
+        assert is_fresh(feats_dir, 'vid0', get_sources('vid0'), settings)
+        with open(get_sources('vid1')[0], 'wb') as f:
+            f.write('changed')
+        assert not is_fresh(feats_dir, 'vid1', get_sources('vid1'), settings)
+        os.remove(feats_dir+'vid2.npy')
+        assert not is_fresh(feats_dir, 'vid2', get_sources('vid2'), settings)
+        assert not is_fresh(feats_dir, 'vid3', get_sources('vid3'), dict(settings, frame_spacing=8))
+        assert [vid for vid, _ in stale_videos(feats_dir, vids, get_sources, settings)] == ['vid1', 'vid2'] + vids[5:]
+        assert read_entry(feats_dir, 'vid4')['selected'] == [0, 4, 8]
+    finally:
+        shutil.rmtree(tmp_dir)
+    print 'manifest tests pass'
+
+if __name__ == '__main__':
+    test_manifest()
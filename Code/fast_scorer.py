@@ -0,0 +1,233 @@
+import string, time
+import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
+
+import preprocess
+
+# BLEU-1..4, ROUGE-L and CIDEr-D as computed by coco-caption, without Java: captions are
+# tokenized by preprocess.tokenize and the n-grams counted into sparse matrices whose
+# columns are the n-grams hashed by a dict. For in-training validation, METEOR and the
+# PTB tokenizer are left to cocoeval.COCOScorer for the final evaluation.
+
+PUNCT_DICT = preprocess.get_punctuations()
+TRANSLATOR = string.maketrans("", "")
+
+def tokenize_caption(caption):
+    # tokens of a caption by the rules of preprocess.tokenize, [] for an empty one
+    if isinstance(caption, unicode):
+        caption = caption.encode('utf-8')
+    if not caption.strip():
+        return []
+    return preprocess.tokenize(caption, PUNCT_DICT, TRANSLATOR)[0]
+
+def count_ngrams(sentences, k, columns):
+    # (len(sentences), len(columns)) sparse counts of the k-grams of the token lists,
+    # new k-grams get new columns
+    rows, cols = [], []
+    for row, tokens in enumerate(sentences):
+        for i in xrange(len(tokens)-k+1):
+            rows.append(row)
+            cols.append(columns.setdefault(tuple(tokens[i:i+k]), len(columns)))
+    # duplicate (row, col) entries are summed into counts
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(sentences), len(columns)))
+
+def widen(matrix, n_columns):
+    # the csr matrix with zero columns appended up to n_columns
+    return sp.csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                         shape=(matrix.shape[0], n_columns))
+
+def group_max(matrix, groups, n_groups):
+    # (n_groups, n_columns) element-wise max of the rows of matrix in each group
+    matrix = matrix.tocoo()
+    keys = groups[matrix.row].astype('int64')*matrix.shape[1] + matrix.col
+    order = np.argsort(keys, kind='mergesort')
+    keys, values = keys[order], matrix.data[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    keys = keys[starts]
+    return sp.csr_matrix((np.maximum.reduceat(values, starts),
+                          (keys//matrix.shape[1], keys%matrix.shape[1])),
+                         shape=(n_groups, matrix.shape[1]))
+
+def pad_ids(sentences, columns, pad):
+    # (len(sentences), max length) word ids of the token lists, padded with pad
+    ids = np.empty((len(sentences), max([len(tokens) for tokens in sentences]+[1])), dtype='int64')
+    ids.fill(pad)
+    for row, tokens in enumerate(sentences):
+        ids[row, :len(tokens)] = [columns.setdefault((token,), len(columns)) for token in tokens]
+    return ids
+
+def lcs_lengths(a, b):
+    # lengths of the longest common subsequences of the rows of a and b, their pads never match
+    prev = np.zeros((a.shape[0], b.shape[1]+1), dtype='int64')
+    for i in xrange(a.shape[1]):
+        match = a[:, i:i+1] == b
+        cur = np.zeros_like(prev)
+        for j in xrange(b.shape[1]):
+            cur[:, j+1] = np.where(match[:, j], prev[:, j]+1, np.maximum(prev[:, j+1], cur[:, j]))
+        prev = cur
+    return prev[:, -1]
+
+class FastScorer(object):
+    '''
+    The references of a split counted once, like cocoeval.ReferenceCache: score then
+    tokenizes and counts the candidates only. Same interface as cocoeval.COCOScorer
+    with GT and IDs given up front, and no METEOR.
+    '''
+    def __init__(self, GT, IDs, n=4, sigma=6.0, beta=1.2):
+        self.GT = GT
+        self.IDs = list(IDs)
+        self.n, self.sigma, self.beta = n, sigma, beta
+        self.timing = OrderedDict()
+        refs = [[tokenize_caption(cap['caption']) for cap in GT[ID]] for ID in self.IDs]
+        # reference row -> video row
+        self.groups = np.concatenate([np.repeat(row, len(caps)) for row, caps in enumerate(refs)])
+        self.n_refs = np.bincount(self.groups, minlength=len(self.IDs))
+        refs = [tokens for caps in refs for tokens in caps]
+        self.ref_lens = np.array([len(tokens) for tokens in refs])
+        self.columns = [{} for k in xrange(n)]
+        self.ref_counts = [count_ngrams(refs, k+1, self.columns[k]) for k in xrange(n)]
+        # BLEU: clipping counts
+        self.ref_max_counts = [group_max(counts, self.groups, len(self.IDs)) for counts in self.ref_counts]
+        # CIDEr-D: idf from the number of videos with the n-gram in their references
+        self.log_n_videos = np.log(float(len(self.IDs)))
+        indicator = sp.csr_matrix((np.ones(len(self.groups)), (self.groups, np.arange(len(self.groups)))),
+                                  shape=(len(self.IDs), len(self.groups)))
+        self.idfs, self.ref_vecs, self.ref_norms = [], [], []
+        for k in xrange(n):
+            df = np.asarray(((indicator*(self.ref_counts[k] > 0)) > 0).sum(axis=0)).ravel()
+            self.idfs.append(self.log_n_videos - np.log(np.maximum(1., df)))
+            vecs = self.ref_counts[k].multiply(self.idfs[k]).tocsr()
+            self.ref_vecs.append(vecs)
+            self.ref_norms.append(np.sqrt(np.asarray(vecs.multiply(vecs).sum(axis=1)).ravel()))
+        # ROUGE-L
+        self.ref_ids = pad_ids(refs, self.columns[0], -2)
+
+    def bleu(self, tests):
+        tiny, small = 1e-15, 1e-9
+        test_lens = np.array([len(tokens) for tokens in tests])
+        # closest reference length, the shortest one on ties
+        keys = np.abs(self.ref_lens - test_lens[self.groups])*100000 + self.ref_lens
+        starts = np.r_[0, np.cumsum(self.n_refs)[:-1]]
+        ref_lens = np.minimum.reduceat(keys, starts) % 100000
+        guess = np.array([np.maximum(0, test_lens-k) for k in xrange(self.n)], dtype='float64')
+        correct = np.zeros_like(guess)
+        for k in xrange(self.n):
+            counts = count_ngrams(tests, k+1, dict(self.columns[k]))
+            ref_max_counts = widen(self.ref_max_counts[k], counts.shape[1])
+            correct[k] = np.asarray(counts.minimum(ref_max_counts).sum(axis=1)).ravel()
+        # corpus scores and per video scores
+        ratio = (test_lens.sum()+tiny) / (ref_lens.sum()+small)
+        score = np.cumprod((correct.sum(axis=1)+tiny) / (guess.sum(axis=1)+small))
+        score = score ** (1./np.arange(1, self.n+1))
+        scores = np.cumprod((correct+tiny) / (guess+small), axis=0)
+        scores = scores ** (1./np.arange(1, self.n+1))[:, None]
+        if ratio < 1:
+            score *= np.exp(1 - 1/ratio)
+        ratios = (test_lens+tiny) / (ref_lens+small)
+        scores[:, ratios < 1] *= np.exp(1 - 1/ratios[ratios < 1])
+        return list(score), [list(s) for s in scores]
+
+    def rouge(self, tests):
+        test_lens = np.array([len(tokens) for tokens in tests])[self.groups]
+        columns = dict(self.columns[0])
+        lcs = lcs_lengths(pad_ids(tests, columns, -1)[self.groups], self.ref_ids).astype('float64')
+        prec = np.zeros_like(lcs)
+        prec[test_lens > 0] = lcs[test_lens > 0] / test_lens[test_lens > 0]
+        rec = lcs / np.maximum(self.ref_lens, 1)
+        starts = np.r_[0, np.cumsum(self.n_refs)[:-1]]
+        prec, rec = np.maximum.reduceat(prec, starts), np.maximum.reduceat(rec, starts)
+        scores = np.zeros_like(prec)
+        nonzero = (prec != 0) & (rec != 0)
+        scores[nonzero] = ((1 + self.beta**2)*prec[nonzero]*rec[nonzero]) / \
+            (rec[nonzero] + self.beta**2*prec[nonzero])
+        return scores.mean(), scores
+
+    def cider(self, tests):
+        # bigram counts as lengths, as coco-caption does
+        lengths = np.maximum(np.array([len(tokens) for tokens in tests]) - 1, 0)
+        delta = (lengths[self.groups] - np.maximum(self.ref_lens - 1, 0)).astype('float64')
+        penalty = np.exp(-(delta**2) / (2*self.sigma**2))
+        sims = np.zeros(len(self.groups))
+        for k in xrange(self.n):
+            counts = count_ngrams(tests, k+1, dict(self.columns[k]))
+            # n-grams of no reference have df 0
+            idf = np.r_[self.idfs[k], np.repeat(self.log_n_videos, counts.shape[1] - len(self.idfs[k]))]
+            vecs = counts.multiply(idf).tocsr()
+            norms = np.sqrt(np.asarray(vecs.multiply(vecs).sum(axis=1)).ravel())[self.groups]
+            vecs = vecs[self.groups]
+            ref_vecs = widen(self.ref_vecs[k], counts.shape[1])
+            # clipped by the reference
+            val = np.asarray(vecs.minimum(ref_vecs).multiply(ref_vecs).sum(axis=1)).ravel()
+            denominator = norms*self.ref_norms[k]
+            val[denominator != 0] /= denominator[denominator != 0]
+            sims += val*penalty
+        scores = 10.0*np.bincount(self.groups, weights=sims) / (self.n*self.n_refs)
+        return np.mean(scores), scores
+
+    def score(self, RES):
+        self.eval = {}
+        self.imgToEval = {}
+        t0 = time.time()
+        tests = [tokenize_caption(RES[ID][0]['caption']) for ID in self.IDs]
+        self.timing = OrderedDict([('tokenization', time.time() - t0)])
+        for name, method, compute in [('Bleu', ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"], self.bleu),
+                                      ('ROUGE_L', "ROUGE_L", self.rouge),
+                                      ('CIDEr', "CIDEr", self.cider)]:
+            t0 = time.time()
+            score, scores = compute(tests)
+            self.timing[name] = time.time() - t0
+            if type(method) == list:
+                for sc, scs, m in zip(score, scores, method):
+                    self.setEval(sc, m)
+                    self.setImgToEvalImgs(scs, self.IDs, m)
+            else:
+                self.setEval(score, method)
+                self.setImgToEvalImgs(scores, self.IDs, method)
+        print 'timing: ' + ', '.join('%s %.2f sec'%(name, duration)
+                                     for name, duration in self.timing.items())
+        for metric, score in self.eval.items():
+            print '%s: %.3f'%(metric, score)
+        return self.eval
+
+    def setEval(self, score, method):
+        self.eval[method] = score
+
+    def setImgToEvalImgs(self, scores, imgIds, method):
+        for imgId, score in zip(imgIds, scores):
+            if not imgId in self.imgToEval:
+                self.imgToEval[imgId] = {}
+                self.imgToEval[imgId]["image_id"] = imgId
+            self.imgToEval[imgId][method] = score
+
+def test_fast_scorer(n_videos=50, seed=1234):
+    # same scores as coco-caption on the same tokens
+    from coco.pycocoevalcap.bleu.bleu import Bleu
+    from coco.pycocoevalcap.rouge.rouge import Rouge
+    from coco.pycocoevalcap.cider.cider import Cider
+    rng = np.random.RandomState(seed)
+    words = 'a man woman is are playing guitar cutting an onion the dog runs on grass cat'.split()
+    sentence = lambda: ' '.join(rng.choice(words, rng.randint(1, 12)))
+    IDs = ['vid%d'%i for i in xrange(n_videos)]
+    GT = OrderedDict((ID, [{'image_id': ID, 'caption': sentence()} for _ in xrange(rng.randint(1, 8))]) for ID in IDs)
+    # candidates overlapping with the references: one of them with words replaced
+    def candidate(ID):
+        tokens = rng.choice(GT[ID])['caption'].split()
+        return ' '.join(rng.choice(words) if rng.rand() < 0.3 else token for token in tokens)
+    RES = OrderedDict((ID, [{'image_id': ID, 'caption': candidate(ID)}]) for ID in IDs)
+    scorer = FastScorer(GT, IDs)
+    fast = scorer.score(RES)
+    gts = OrderedDict((ID, [' '.join(tokenize_caption(cap['caption'])) for cap in GT[ID]]) for ID in IDs)
+    res = OrderedDict((ID, [' '.join(tokenize_caption(RES[ID][0]['caption']))]) for ID in IDs)
+    for coco_scorer, method in [(Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
+                                (Rouge(), ["ROUGE_L"]), (Cider(), ["CIDEr"])]:
+        score, scores = coco_scorer.compute_score(gts, res)
+        if type(score) != list:
+            score, scores = [score], [scores]
+        for m, sc, scs in zip(method, score, scores):
+            assert abs(fast[m] - sc) < 1e-6, (m, fast[m], sc)
+            assert np.allclose([scorer.imgToEval[ID][m] for ID in IDs], scs), m
+    print 'fast scores match coco-caption'
+
+if __name__ == '__main__':
+    test_fast_scorer()
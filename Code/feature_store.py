@@ -0,0 +1,66 @@
+import os
+import numpy as np
+from collections import OrderedDict
+import utils, config
+
+def get_store_paths(feats_dir):
+    # ../Data/MSVD/Features/ResNet152/ -> ../Data/MSVD/Features/ResNet152_packed.npy
+    prefix = feats_dir[:-1] if feats_dir[-1] == '/' else feats_dir
+    return prefix+'_packed.npy', prefix+'_packed_index.json'
+
+def build_feature_store(feats_dir, vid_ids, ctx_frames, ctx_dim):
+    '''
+    Pack the per-video .npy features of feats_dir into one (n_videos, ctx_frames, ctx_dim)
+    float32 array on disk. Videos with fewer than ctx_frames frames are zero padded,
+    which get_ctx_mask already treats as masked out.
+    '''
+    store_path, index_path = get_store_paths(feats_dir)
+    print 'packing %d videos from %s into %s'%(len(vid_ids), feats_dir, store_path)
+    store = np.lib.format.open_memmap(store_path, mode='w+', dtype=np.float32,
+                                      shape=(len(vid_ids), ctx_frames, ctx_dim))
+    index = OrderedDict()
+    for row, vid_id in enumerate(vid_ids):
+        feat = np.load(feats_dir+vid_id+'.npy')
+        if feat.shape[0] > ctx_frames or feat.shape[-1] != ctx_dim:
+            raise ValueError('%s has features of shape %s, expected at most (%d, %d)'%(
+                vid_id, feat.shape, ctx_frames, ctx_dim))
+        store[row, :feat.shape[0]] = feat
+        index[vid_id] = row
+    store.flush()
+    del store
+    utils.write_to_json(index, index_path)
+    return load_feature_store(feats_dir)
+
+def load_feature_store(feats_dir):
+    # returns (store, index) with store memory-mapped read-only, or None if not built yet
+    store_path, index_path = get_store_paths(feats_dir)
+    if not (os.path.exists(store_path) and os.path.exists(index_path)):
+        return None
+    store = np.load(store_path, mmap_mode='r')
+    index = utils.read_from_json(index_path)
+    return store, index
+
+def newer_sources(feats_dir, vid_ids):
+    # the videos whose .npy features were written after the packed store, re-extracted since
+    store_mtime = os.path.getmtime(get_store_paths(feats_dir)[0])
+    return [vid_id for vid_id in vid_ids if os.path.exists(feats_dir+vid_id+'.npy')
+            and os.path.getmtime(feats_dir+vid_id+'.npy') > store_mtime]
+
+def get_feature_store(feats_dir, vid_ids, ctx_frames, ctx_dim):
+    # load the packed store, (re)building it if it is missing videos, has the wrong shape
+    # or is older than some of the features it packs
+    rval = load_feature_store(feats_dir)
+    if rval is not None:
+        store, index = rval
+        if store.shape[1:] == (ctx_frames, ctx_dim) and all(vid_id in index for vid_id in vid_ids) \
+                and not newer_sources(feats_dir, vid_ids):
+            return store, index
+        print 'feature store %s is stale, rebuilding'%get_store_paths(feats_dir)[0]
+        del store
+    return build_feature_store(feats_dir, vid_ids, ctx_frames, ctx_dim)
+
+if __name__ == '__main__':
+    cnn = "ResNet152"
+    vid_ids = [vid[:-4] for vid in utils.read_file_to_list(config.DATA_DIR+"present_vid_ids.txt")]
+    assert len(vid_ids)==config.TOTAL_VIDS
+    build_feature_store(config.MSVD_FEATS_DIR+cnn+"/", vid_ids, config.FRAME_SPACING, config.RESNET_FEAT_DIM)
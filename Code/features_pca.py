@@ -3,6 +3,7 @@ from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
 import numpy as np
 import utils, config
+import extraction_manifest
 
 def feats_pca(cnn, vid_ids_path, num_vids, org_dim, new_dim):
 
@@ -14,6 +15,12 @@ def feats_pca(cnn, vid_ids_path, num_vids, org_dim, new_dim):
 	vid_clips_list = [vid[:-4] for vid in vid_ids]
 	assert len(vid_ids)==num_vids
 
+	# the pca is fit on all the videos, one stale video means redoing them all
+	get_sources = lambda vid: [config.MSVD_FEATS_DIR+cnn+"/"+vid+".npy"]
+	settings = {'org_dim': org_dim, 'new_dim': new_dim}
+	if not extraction_manifest.stale_videos(feat_save_path, vid_clips_list, get_sources, settings):
+		return
+
 	vid_feats_all = np.empty((0,org_dim), dtype=np.float32)
 	for vid in vid_clips_list:
 		# print("loading features from : "+vid)
@@ -33,10 +40,13 @@ def feats_pca(cnn, vid_ids_path, num_vids, org_dim, new_dim):
 		vid = vid_clips_list[ind]
 		vid_feat = vid_feats_pca[ind]
 		# print("saving features from : "+vid)
-		np.save(feat_save_path+vid+".npy",vid_feat)
+		extraction_manifest.save_features(feat_save_path+vid+".npy",vid_feat)
+		extraction_manifest.write_entry(feat_save_path, vid, extraction_manifest.make_entry(
+			get_sources(vid), settings, vid_feat.shape))
 
 
-def feats_kmeans(cnn, vid_ids_path, num_vids, org_dim, k):
+def feats_kmeans(cnn, vid_ids_path, num_vids, org_dim, k, worker_id=0, n_workers=1):
+	# worker_id, n_workers: only cluster this run's share of the videos without up to date centers
 
 	feat_save_path = config.MSVD_FEATS_DIR+cnn+"_kmeans"+str(k)+"/"
 	print "saving feats to :", feat_save_path
@@ -46,15 +56,21 @@ def feats_kmeans(cnn, vid_ids_path, num_vids, org_dim, k):
 	vid_clips_list = [vid[:-4] for vid in vid_ids]
 	assert len(vid_ids)==num_vids
 
-	for vid in vid_clips_list:
+	get_sources = lambda vid: [config.MSVD_FEATS_DIR+cnn+"/"+vid+".npy"]
+	settings = {'org_dim': org_dim, 'k': k}
+	todo = extraction_manifest.stale_videos(feat_save_path, vid_clips_list, get_sources, settings,
+		worker_id, n_workers)
+	for vid, sources in todo:
 		# print("loading features from : "+vid)
-		vid_feats_path = config.MSVD_FEATS_DIR+cnn+"/"+vid+".npy"
+		vid_feats_path = sources[0]
 		vid_feats = np.load(vid_feats_path)
 		# print(vid_feats.shape)
 		kmeans = KMeans(n_clusters=k, init='k-means++', random_state=0).fit(vid_feats)
 		vid_feat_kmeans = kmeans.cluster_centers_
 		# print(vid_feat_kmeans.shape)
-		np.save(feat_save_path+vid+".npy",vid_feat_kmeans)
+		extraction_manifest.save_features(feat_save_path+vid+".npy",vid_feat_kmeans)
+		extraction_manifest.write_entry(feat_save_path, vid, extraction_manifest.make_entry(
+			sources, settings, vid_feat_kmeans.shape, n_frames=vid_feats.shape[0]))
 
 if __name__ == '__main__':
 	cnn = "ResNet152"
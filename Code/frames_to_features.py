@@ -7,43 +7,110 @@ from keras.applications.vgg19 import preprocess_input as vgg19_preprocess_input
 from cnn.resnet152 import ResNet152
 from keras.applications.imagenet_utils import preprocess_input
 from keras.preprocessing import image
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawArray
+import cv2, itertools, os, sys, time, traceback
 import numpy as np
 import utils, config
+import extraction_manifest
+
+# input height and width of every cnn, known before its model is loaded
+INPUT_SIZES = {
+    "ResNet50": (224, 224),
+    "ResNet152": (224, 224),
+    "InceptionV3": (229, 229),
+    "VGG19": (224, 224),
+}
 
 def get_ResNet50_model():
     # get pool5 layer output
     model = ResNet50(weights='imagenet', include_top=False, pooling="avg")
-    height = 224
-    width = 224
+    height, width = INPUT_SIZES["ResNet50"]
     return model, height, width, resnet50_preprocess_input
 
 def get_ResNet152_model():
     # get pool5 layer output
     model = ResNet152(weights='imagenet', include_top=False, pooling="avg")
-    height = 224
-    width = 224
+    height, width = INPUT_SIZES["ResNet152"]
     return model, height, width, preprocess_input
 
 def get_InceptionV3_model():
     model = InceptionV3(weights='imagenet', include_top=False, pooling="avg")
-    height = 229
-    width = 229
+    height, width = INPUT_SIZES["InceptionV3"]
     return model, height, width, inception_v3_preprocess_input
 
 def get_VGG19_model():
     model = VGG19(weights='imagenet', include_top=False, pooling="avg")
-    height = 224
-    width = 224
+    height, width = INPUT_SIZES["VGG19"]
     return model, height, width, vgg19_preprocess_input
 
-def img_to_feat(img_path, height, width, preprocess_input, model):
+def get_cnn_model(cnn):
+    # model, input height and width, preprocessing and feature dimension of cnn
+    if cnn=="ResNet50":
+        return get_ResNet50_model() + (config.RESNET_FEAT_DIM,)
+    elif cnn=="ResNet152":
+        return get_ResNet152_model() + (config.RESNET_FEAT_DIM,)
+    elif cnn=="InceptionV3":
+        return get_InceptionV3_model() + (config.INCEPTION_FEAT_DIM,)
+    elif cnn=="VGG19":
+        return get_VGG19_model() + (config.VGG_FEAT_DIM,)
+    raise NotImplementedError()
+
+def load_frame(img_path, height, width):
+    # (height, width, 3) float32 RGB image
     img = image.load_img(img_path, target_size=(height, width))
-    x = image.img_to_array(img)
+    return image.img_to_array(img)
+
+def img_to_feat(img_path, height, width, preprocess_input, model):
+    x = load_frame(img_path, height, width)
     x = np.expand_dims(x, axis=0)
     x = preprocess_input(x)
     feat = model.predict(x)
     return feat   
 
+def predict_batch(model, preprocess_input, batch, owners, pending):
+    # one model.predict on the frames of batch, their features scattered to the videos owning them
+    feats = model.predict(preprocess_input(batch[:len(owners)]), batch_size=len(owners))
+    for (vid, row), feat in zip(owners, feats):
+        pending[vid][0][row] = feat
+        pending[vid][1] -= 1
+    del owners[:]
+
+def pop_finished(pending):
+    # (vid, features) of the videos at the head of pending with every frame predicted
+    finished = []
+    while pending and pending.values()[0][1] == 0:
+        vid, (feats, _) = pending.popitem(last=False)
+        finished.append((vid, feats))
+    return finished
+
+def batched_features(videos, model, preprocess_input, feat_dim, batch_size=32):
+    '''
+    Features of the frames of many videos with one model.predict per batch_size frames,
+    batches running across videos. videos: iterable of (vid, n_frames, frames), frames
+    an iterable of n_frames (height, width, 3) images. Yields (vid, (n_frames, feat_dim)
+    features) in the order of videos, as soon as all the frames of vid are predicted.
+    '''
+    batch = None
+    owners = []     # (vid, row) of every frame in batch
+    pending = OrderedDict()     # vid -> [preallocated features, frames left to predict]
+    for vid, n_frames, frames in videos:
+        pending[vid] = [np.empty((n_frames, feat_dim), dtype=np.float32), n_frames]
+        for row, frame in enumerate(frames):
+            if batch is None:
+                batch = np.empty((batch_size,) + frame.shape, dtype=np.float32)
+            batch[len(owners)] = frame
+            owners.append((vid, row))
+            if len(owners) == batch_size:
+                predict_batch(model, preprocess_input, batch, owners, pending)
+        for finished in pop_finished(pending):
+            yield finished
+    if owners:
+        predict_batch(model, preprocess_input, batch, owners, pending)
+    for finished in pop_finished(pending):
+        yield finished
+
 def extract_frames_equally_spaced(n_frames, how_many):
     # chunk frames into 'how_many' segments and use the first frame from each segment
     if n_frames < how_many:
@@ -53,49 +120,320 @@ def extract_frames_equally_spaced(n_frames, how_many):
         idx_taken = [s[0] for s in splits]
     return idx_taken
 
-def frames_to_feat(cnn, vid_ids_path, num_vids):
-    if cnn=="ResNet50":
-        model, height, width, preprocess_input = get_ResNet50_model()
-        FEAT_DIM = config.RESNET_FEAT_DIM
-    elif cnn=="ResNet152":
-        model, height, width, preprocess_input = get_ResNet152_model()
-        FEAT_DIM = config.RESNET_FEAT_DIM
-    elif cnn=="InceptionV3":
-        model, height, width, preprocess_input = get_InceptionV3_model()
-        FEAT_DIM = config.INCEPTION_FEAT_DIM
-    elif cnn=="VGG19":
-        model, height, width, preprocess_input = get_VGG19_model()
-        FEAT_DIM = config.VGG_FEAT_DIM
-    else:
-        raise NotImplementedError()
+def select_frames(n_frames):
+    # the equally spaced frames that get features out of the n_frames of a video
+    return extract_frames_equally_spaced(min(n_frames, config.MAX_FRAMES), config.FRAME_SPACING)
+
+def frames_dir_selection(vid):
+    # (n_frames, selected frames) of vid in its Frames/ directory
+    n_frames = len(utils.read_dir(config.MSVD_FRAMES_DIR+"/"+vid))
+    return n_frames, select_frames(n_frames)
+
+def get_frame_path(vid, fid):
+    return config.MSVD_FRAMES_DIR+"/"+vid+"/frame"+str(fid)+".jpg"
+
+def selected_frame_paths(vid):
+    # the equally spaced frames of vid that get features
+    _, selected_frames = frames_dir_selection(vid)
+    return [get_frame_path(vid, fid) for fid in selected_frames]
+
+def read_frames(video_path, fids):
+    '''
+    RGB frames fids (sorted) of the clip at video_path, or None and the number of frames
+    if the clip ends before. Frames are grabbed in order, seeking is not frame accurate on
+    most codecs, and only the ones in fids are retrieved as images.
+    '''
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    n_grabbed = 0
+    try:
+        for fid in fids:
+            while n_grabbed <= fid:
+                if not cap.grab():
+                    return None, n_grabbed
+                n_grabbed += 1
+            _, frame = cap.retrieve()
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        cap.release()
+    return frames, n_grabbed
+
+def decode_selected_frames(video_path):
+    '''
+    (frames, selected frames, n_frames) of the clip at video_path, the frames being the
+    equally spaced ones selected_frame_paths would take from its Frames/ directory.
+    '''
+    cap = cv2.VideoCapture(video_path)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    fids = select_frames(n_frames)
+    frames, n_grabbed = read_frames(video_path, fids)
+    if frames is None:
+        # the container overstates its frame count, select among the frames there are
+        n_frames = n_grabbed
+        fids = select_frames(n_frames)
+        frames, _ = read_frames(video_path, fids)
+    return frames, fids, n_frames
+
+def resize_frame(frame, height, width):
+    # (height, width, 3) float32, nearest neighbour like image.load_img
+    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_NEAREST)
+    return frame.astype(np.float32)
+
+def get_extraction_settings(cnn, from_video):
+    # what the features of a video depend on besides its sources, for the manifest
+    return {'cnn': cnn, 'from_video': from_video,
+            'max_frames': config.MAX_FRAMES, 'frame_spacing': config.FRAME_SPACING}
 
+def videos_to_extract(feat_save_path, vid_ids, settings, worker_id=0, n_workers=1):
+    # (vid, sources) of the videos of this worker without up to date features in feat_save_path
+    vid_files = dict((vid_id[:-4], vid_id) for vid_id in vid_ids)
+    def get_sources(vid):
+        if settings['from_video']:
+            return [config.MSVD_VIDEO_DATA_PATH+vid_files[vid]]
+        return selected_frame_paths(vid)
+    return extraction_manifest.stale_videos(feat_save_path, [vid_id[:-4] for vid_id in vid_ids],
+                                            get_sources, settings, worker_id, n_workers)
+
+def save_extracted(feat_save_path, vid, vid_feats, sources, settings, selected, n_frames):
+    # the features first, a video only counts as done once its manifest entry is written
+    extraction_manifest.save_features(feat_save_path+vid+".npy", vid_feats)
+    extraction_manifest.write_entry(feat_save_path, vid, extraction_manifest.make_entry(
+        sources, settings, vid_feats.shape, n_frames=n_frames, selected=selected))
+
+def frames_to_feat(cnn, vid_ids_path, num_vids, batch_size=32, from_video=False, worker_id=0, n_workers=1):
+    # batch_size: frames per model.predict, taken from as many videos as needed
+    # from_video: decode the sampled frames straight from the clips instead of reading the
+    # JPEGs of video_to_frames, nothing is written besides the features
+    # worker_id, n_workers: this run only extracts its share of the videos without up to date
+    # features, several runs can work on the same cnn at the same time
     feat_save_path = config.MSVD_FEATS_DIR+cnn+"/"
     print "saving feats to :", feat_save_path
     utils.create_dir_if_not_exist(feat_save_path)
 
     vid_ids = utils.read_file_to_list(vid_ids_path)
-    vid_clips_list = [vid[:-4] for vid in vid_ids]
     assert len(vid_ids)==num_vids
+    settings = get_extraction_settings(cnn, from_video)
+    todo = videos_to_extract(feat_save_path, vid_ids, settings, worker_id, n_workers)
+    if not todo:
+        return
+    model, height, width, preprocess_input, FEAT_DIM = get_cnn_model(cnn)
+
+    selections = {}
+    def videos():
+        for vid, sources in todo:
+            print("extracting features from : "+vid)
+            if from_video:
+                frames, fids, n_frames = decode_selected_frames(sources[0])
+                selections[vid] = fids, n_frames
+                yield vid, len(frames), (resize_frame(frame, height, width) for frame in frames)
+            else:
+                n_frames, fids = frames_dir_selection(vid)
+                selections[vid] = fids, n_frames
+                img_paths = [get_frame_path(vid, fid) for fid in fids]
+                yield vid, len(img_paths), (load_frame(img_path, height, width) for img_path in img_paths)
 
-    for vid in vid_clips_list:
-        print("extracting features from : "+vid)
-        vid_frames_dir = config.MSVD_FRAMES_DIR+"/"+vid
-        frames_list = utils.read_dir(vid_frames_dir)
-        n_frames = len(frames_list)
-        if n_frames > config.MAX_FRAMES:
-            n_frames = config.MAX_FRAMES
-        selected_frames = extract_frames_equally_spaced(n_frames,config.FRAME_SPACING)
-        vid_feats = np.empty((0,FEAT_DIM), dtype=np.float32)
-        for fid in selected_frames:
-            img_path = vid_frames_dir+"/frame"+str(fid)+".jpg"
-            # print("extracting features from : "+img_path)
-            img_feat = img_to_feat(img_path,height,width,preprocess_input,model)
-            vid_feats = np.vstack((vid_feats,img_feat))
+    sources = dict(todo)
+    for vid, vid_feats in batched_features(videos(), model, preprocess_input, FEAT_DIM, batch_size):
         print(vid_feats.shape)
-        np.save(feat_save_path+vid+".npy",vid_feats)
+        save_extracted(feat_save_path, vid, vid_feats, sources[vid], settings, *selections.pop(vid))
+
+def decode_worker(jobs, slots_buffer, slots_shape, free_slots, filled):
+    '''
+    Decode the clips put in jobs as (vid, video_path) until None comes: the resized sampled
+    frames of each clip go to a free slot of the shared slots_buffer, taken from free_slots,
+    and (vid, slot, selected frames, n_frames) to filled. Puts None in filled when done.
+    '''
+    slots = np.frombuffer(slots_buffer, dtype=np.uint8).reshape(slots_shape)
+    height, width = slots_shape[2:4]
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            vid, video_path = job
+            frames, fids, n_frames = decode_selected_frames(video_path)
+            slot = free_slots.get()
+            for row, frame in enumerate(frames):
+                slots[slot, row] = resize_frame(frame, height, width)
+            filled.put((vid, slot, fids, n_frames))
+    except Exception:
+        filled.put(traceback.format_exc())
+    finally:
+        filled.put(None)
+
+def slot_frames(slots, free_slots, slot, n_frames):
+    # the frames of a slot, which is given back once the last one is copied to a batch
+    for row in xrange(n_frames):
+        yield slots[slot, row]
+    free_slots.put(slot)
+
+def decoded_videos(slots, free_slots, filled, n_decoders, stats, selections):
+    # (vid, n_frames, frames) of the clips in the order the decoders finish them
+    n_running = n_decoders
+    while n_running > 0:
+        item = filled.get()
+        if item is None:
+            n_running -= 1
+            continue
+        if isinstance(item, str):
+            raise RuntimeError('decoder failed:\n'+item)
+        vid, slot, fids, n_frames = item
+        selections[vid] = fids, n_frames
+        stats['clips'] += 1
+        stats['frames'] += len(fids)
+        yield vid, len(fids), slot_frames(slots, free_slots, slot, len(fids))
+
+def report_throughput(stats, t0):
+    seconds = time.time() - t0
+    print('%d clips, %d frames in %.1fs: %.2f clips/sec, %.1f frames/sec'%(
+        stats['clips'], stats['frames'], seconds,
+        stats['clips'] / max(seconds, 1e-6), stats['frames'] / max(seconds, 1e-6)))
+
+def parallel_frames_to_feat(cnn, vid_ids_path, num_vids, n_decoders=4, batch_size=32, n_slots=None,
+                            worker_id=0, n_workers=1):
+    '''
+    frames_to_feat(from_video=True) with the clips decoded by n_decoders processes while
+    this one runs the model on batches across clips. Decoders write the resized frames of
+    a clip to one of n_slots shared memory slots and block while none is free, so decoding
+    runs at most n_slots clips ahead of the model.
+    '''
+    height, width = INPUT_SIZES[cnn]
+    n_slots = n_slots or 2 * n_decoders
+    feat_save_path = config.MSVD_FEATS_DIR+cnn+"/"
+    print "saving feats to :", feat_save_path
+    utils.create_dir_if_not_exist(feat_save_path)
+
+    vid_ids = utils.read_file_to_list(vid_ids_path)
+    assert len(vid_ids)==num_vids
+    settings = get_extraction_settings(cnn, True)
+    todo = videos_to_extract(feat_save_path, vid_ids, settings, worker_id, n_workers)
+    if not todo:
+        return {'clips': 0, 'frames': 0}
+
+    slots_shape = (n_slots, config.FRAME_SPACING, height, width, 3)
+    slots_buffer = RawArray('B', int(np.prod(slots_shape)))
+    slots = np.frombuffer(slots_buffer, dtype=np.uint8).reshape(slots_shape)
+    jobs, free_slots, filled = Queue(), Queue(), Queue(maxsize=n_slots + 2 * n_decoders)
+    for vid, sources in todo:
+        jobs.put((vid, sources[0]))
+    for slot in xrange(n_slots):
+        free_slots.put(slot)
+    # the decoders are started before the model is loaded, they must not inherit a session
+    decoders = [Process(target=decode_worker, args=(jobs, slots_buffer, slots_shape, free_slots, filled))
+                for _ in xrange(n_decoders)]
+    for decoder in decoders:
+        decoder.daemon = True
+        decoder.start()
+        jobs.put(None)
+    try:
+        model, _, _, preprocess_input, FEAT_DIM = get_cnn_model(cnn)
+        stats = {'clips': 0, 'frames': 0}
+        selections = {}
+        sources = dict(todo)
+        t0 = time.time()
+        videos = decoded_videos(slots, free_slots, filled, n_decoders, stats, selections)
+        rval = batched_features(videos, model, preprocess_input, FEAT_DIM, batch_size)
+        for n_saved, (vid, vid_feats) in enumerate(rval, 1):
+            save_extracted(feat_save_path, vid, vid_feats, sources[vid], settings, *selections.pop(vid))
+            if n_saved % 100 == 0:
+                report_throughput(stats, t0)
+        report_throughput(stats, t0)
+    finally:
+        for decoder in decoders:
+            decoder.terminate()
+            decoder.join()
+    return stats
+
+def multi_frames_to_feat(cnns, vid_ids_path, num_vids, batch_size=32, worker_id=0, n_workers=1):
+    '''
+    frames_to_feat(from_video=True) for several cnns in one pass over the clips: the sampled
+    frames of a clip are decoded once and resized to the input of each cnn, whose models
+    are all loaded. A clip with stale features for any of cnns is extracted for all of them.
+    '''
+    vid_ids = utils.read_file_to_list(vid_ids_path)
+    assert len(vid_ids)==num_vids
+    position = dict((vid_id[:-4], i) for i, vid_id in enumerate(vid_ids))
+    feat_save_paths, settings, todo = {}, {}, {}
+    for cnn in cnns:
+        feat_save_paths[cnn] = config.MSVD_FEATS_DIR+cnn+"/"
+        print "saving feats to :", feat_save_paths[cnn]
+        utils.create_dir_if_not_exist(feat_save_paths[cnn])
+        settings[cnn] = get_extraction_settings(cnn, True)
+        todo.update(videos_to_extract(feat_save_paths[cnn], vid_ids, settings[cnn], worker_id, n_workers))
+    todo = sorted(todo.items(), key=lambda item: position[item[0]])
+    if not todo:
+        return
+    models = [get_cnn_model(cnn) for cnn in cnns]
+
+    selections = {}
+    def decoded_clips():
+        for vid, sources in todo:
+            print("extracting features from : "+vid)
+            frames, fids, n_frames = decode_selected_frames(sources[0])
+            selections[vid] = fids, n_frames
+            yield vid, frames
+
+    def videos(clips, height, width):
+        for vid, frames in clips:
+            yield vid, len(frames), (resize_frame(frame, height, width) for frame in frames)
+
+    extractors = [batched_features(videos(clips, height, width), model, preprocess_input, feat_dim, batch_size)
+                  for clips, (model, height, width, preprocess_input, feat_dim)
+                  in zip(itertools.tee(decoded_clips(), len(cnns)), models)]
+    sources = dict(todo)
+    # every extractor gets the same number of frames per clip and so finishes the same clip
+    # at the same step, the tee only keeps the clips of about one batch
+    for rval in itertools.izip(*extractors):
+        vid = rval[0][0]
+        assert all(other_vid == vid for other_vid, _ in rval)
+        for cnn, (_, vid_feats) in zip(cnns, rval):
+            print cnn, vid_feats.shape
+            save_extracted(feat_save_paths[cnn], vid, vid_feats, sources[vid], settings[cnn], *selections[vid])
+        del selections[vid]
+
+def test_batched_features():
+    # the features of batches across videos are those of one frame at a time
+    class LinearModel(object):
+        def __init__(self, W):
+            self.W = W
+        def predict(self, x, batch_size=None):
+            return x.reshape(x.shape[0], -1).dot(self.W)
+    rng = np.random.RandomState(1234)
+    model = LinearModel(rng.randn(4*4*3, 8).astype('float32'))
+    frames = OrderedDict(('vid%d'%i, rng.rand(n, 4, 4, 3).astype('float32')) for i, n in enumerate([3, 0, 28, 5, 1]))
+    preprocess_input = lambda x: x * 2. - 1.
+    for batch_size in [1, 4, 32, 100]:
+        videos = ((vid, len(f), iter(f)) for vid, f in frames.items())
+        rval = list(batched_features(videos, model, preprocess_input, 8, batch_size))
+        assert [vid for vid, _ in rval] == frames.keys()
+        for vid, feats in rval:
+            expected = [model.predict(preprocess_input(frame[None])) for frame in frames[vid]]
+            assert feats.shape == (len(frames[vid]), 8)
+            assert np.allclose(feats, np.vstack(expected or [np.empty((0, 8))]), atol=1e-5)
+    print 'batched features match'
+
+def test_decode_selected_frames(video_path='/tmp/test_decode_selected_frames.avi', n_frames=100):
+    # the frames decoded from a clip are the ones selected_frame_paths would pick
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (64, 48))
+    for fid in range(n_frames):
+        writer.write(np.full((48, 64, 3), 2 * fid, dtype=np.uint8))
+    writer.release()
+    frames, fids, n_decoded = decode_selected_frames(video_path)
+    assert n_decoded == n_frames and fids == select_frames(n_frames)
+    assert len(frames) == len(fids)
+    for fid, frame in zip(fids, frames):
+        assert abs(frame.mean() - 2 * fid) < 2, (fid, frame.mean())
+        assert resize_frame(frame, 224, 224).shape == (224, 224, 3)
+    os.remove(video_path)
+    print 'decoded frames match'
 
 if __name__ == '__main__':
     cnn = "ResNet152"
+    # python frames_to_features.py [worker_id n_workers] to share the extraction between runs,
+    # multi_frames_to_feat extracts several cnns in one pass
+    worker_id, n_workers = map(int, sys.argv[1:3]) if len(sys.argv) > 2 else (0, 1)
     print("extracting features from %s..."%cnn)
-    frames_to_feat(cnn, config.DATA_DIR+"present_vid_ids.txt", config.TOTAL_VIDS)
+    parallel_frames_to_feat(cnn, config.DATA_DIR+"present_vid_ids.txt", config.TOTAL_VIDS,
+                            worker_id=worker_id, n_workers=n_workers)
     
\ No newline at end of file
@@ -174,11 +174,13 @@ class Layers(object):
     def lstm_cond_layer(self, tfparams, state_below, options, prefix='lstm',
                         mask=None, context=None, one_step=False,
                         init_memory=None, init_state=None,
-                        trng=None, use_noise=None, mode=None,
+                        trng=None, use_noise=None, mode=None, context_idx=None, pctx=None,
                         **kwargs):
         # state_below (t, m, dim_word), or (m, dim_word) in sampling
         # mask (t, m)
         # context (m, f, dim_ctx), or (1, f, dim_ctx) in sampling
+        # context_idx (m,) row of context for every sample, when samples share contexts
+        # pctx: context already projected through Wc_att, shaped like context
         # init_memory, init_state (m , dim)
         # t = time steps
         # m = batch size
@@ -208,7 +210,15 @@ class Layers(object):
 
         # projected context
         with tf.name_scope("pctx_"):
-            pctx_ = batch_matmul(context, tfparams[_p(prefix, 'Wc_att')]) + tfparams[_p(prefix, 'b_att')]    # (64,28,2048)*(2048,2048)+(2048,) = (64,28,2048) or (1,28,2048) in sampling
+            if pctx is not None:
+                pctx_ = pctx
+            else:
+                pctx_ = batch_matmul(context, tfparams[_p(prefix, 'Wc_att')]) + tfparams[_p(prefix, 'b_att')]    # (64,28,2048)*(2048,2048)+(2048,) = (64,28,2048) or (1,28,2048) in sampling
+        if context_idx is not None:
+            # each distinct context is projected once and then gathered for its samples
+            with tf.name_scope("gather_ctx"):
+                pctx_ = tf.gather(pctx_, context_idx)
+                context = tf.gather(context, context_idx)
         # projected x
         with tf.name_scope("state_below"):
             state_below = batch_matmul(state_below, tfparams[_p(prefix, 'W')]) + tfparams[_p(prefix, 'b')]    # (19,64,512)*(512,2048)+(2048) = (19,64,2048) or (m,2048) in sampling
@@ -4,12 +4,16 @@ import cPickle as pkl
 import copy
 import glob
 import subprocess
-from multiprocessing import Process, Queue, Manager
+from multiprocessing import Process, Queue, Manager, RawArray, Value
 from collections import OrderedDict
+import traceback
+import tensorflow as tf
 
 import train
 import data_engine
-from cocoeval import COCOScorer
+from cocoeval import COCOScorer, ReferenceCache
+from fast_scorer import FastScorer
+from model import Model
 import utils, config
     
 MAXLEN = 50
@@ -30,59 +34,93 @@ def build_sample_pairs(samples, vidIDs):
         D[vidID] = [{'image_id': vidID, 'caption': sample}]
     return D
 
-def score_with_cocoeval(samples_valid, samples_test, engine):
-    scorer = COCOScorer()
-    if samples_valid:
-        gts_valid = OrderedDict()
-        for ID in engine.val_data_ids:
+def get_reference_cache(engine, whichset, scoring='coco'):
+    # references of val or test ready for COCOScorer.score, or a FastScorer of them, built once per engine
+    if (whichset, scoring) not in engine.ref_cache:
+        gts = OrderedDict()
+        for ID in engine.val_data_ids if whichset == 'val' else engine.test_data_ids:
             vidID, capID = ID.split('|')
-            words = engine.get_cap_tokens(vidID, int(capID), mode='val')
+            words = engine.get_cap_tokens(vidID, int(capID), mode=whichset)
             caption = ' '.join(words)
-            if gts_valid.has_key(vidID):
-                gts_valid[vidID].append({'image_id': vidID, 'caption': caption, 'cap_id': capID})
+            if gts.has_key(vidID):
+                gts[vidID].append({'image_id': vidID, 'caption': caption, 'cap_id': capID})
             else:
-                gts_valid[vidID] = [{'image_id': vidID, 'caption': caption, 'cap_id': capID}]
-        valid_score = scorer.score(gts_valid, samples_valid, gts_valid.keys())
+                gts[vidID] = [{'image_id': vidID, 'caption': caption, 'cap_id': capID}]
+        if scoring == 'fast':
+            engine.ref_cache[(whichset, scoring)] = FastScorer(gts, gts.keys())
+        else:
+            engine.ref_cache[(whichset, scoring)] = ReferenceCache(gts, gts.keys())
+    return engine.ref_cache[(whichset, scoring)]
+
+def score_with_cocoeval(samples_valid, samples_test, engine, scorer_service=None, scoring='coco'):
+    # scorer_service: cocoeval.ScorerService kept by the caller across validations
+    # scoring: 'coco' for coco-caption, 'fast' for fast_scorer, all but METEOR without Java
+    if scoring == 'fast':
+        valid_score = get_reference_cache(engine, 'val', 'fast').score(samples_valid) if samples_valid else None
+        test_score = get_reference_cache(engine, 'test', 'fast').score(samples_test) if samples_test else None
+        return valid_score, test_score
+    scorer = COCOScorer(service=scorer_service)
+    if samples_valid:
+        ref_cache = get_reference_cache(engine, 'val')
+        valid_score = scorer.score(ref_cache.GT, samples_valid, ref_cache.IDs, ref_cache=ref_cache)
     else:
         valid_score = None
     if samples_test:
-        gts_test = OrderedDict()
-        for ID in engine.test_data_ids:
-            vidID, capID = ID.split('|')
-            words = engine.get_cap_tokens(vidID, int(capID), mode='test')
-            caption = ' '.join(words)
-            if gts_test.has_key(vidID):
-                gts_test[vidID].append({'image_id': vidID, 'caption': caption, 'cap_id': capID})
-            else:
-                gts_test[vidID] = [{'image_id': vidID, 'caption': caption, 'cap_id': capID}]
-        test_score = scorer.score(gts_test, samples_test, gts_test.keys())
+        ref_cache = get_reference_cache(engine, 'test')
+        test_score = scorer.score(ref_cache.GT, samples_test, ref_cache.IDs, ref_cache=ref_cache)
     else:
         test_score = None
     return valid_score, test_score
 
+def seqs2words(caps, engine):
+    capsw = []
+    for cc in caps:
+        ww = []
+        for w in cc:
+            if w == 0:
+                break
+            ww.append(engine.reverse_vocab[1]
+                      if w > len(engine.reverse_vocab) else engine.reverse_vocab[w])
+        capsw.append(' '.join(ww))
+    return capsw
+
+def get_restrict_voc(engine, options, ctx, ctx_mask):
+    # candidate words of the video for Model.gen_sample, None to decode over every word
+    if options.get('restrict_voc', 0) <= 0:
+        return None
+    if engine.shortlists is None:
+        engine.build_shortlists(options['restrict_voc'], options.get('restrict_voc_neighbors', 5))
+    return engine.get_shortlist(ctx, ctx_mask)
+
 def generate_sample_gpu_single_process(sess,
         model_type, model_archive, options, engine, model,
         f_init, f_next,
         save_dir='./samples/', beam=5,
-        whichset='both'):
-    
-    def _seqs2words(caps):
-        capsw = []
-        for cc in caps:
-            ww = []
-            for w in cc:
-                if w == 0:
-                    break
-                ww.append(engine.reverse_vocab[1]
-                          if w > len(engine.reverse_vocab) else engine.reverse_vocab[w])
-            capsw.append(' '.join(ww))
-        return capsw
+        whichset='both', f_init_batch=None, f_next_batch=None, decode_batch_size=1,
+        f_beam=None):
     
     def sample(whichset):
         samples = []
-        ctxs, ctx_masks = engine.prepare_data_for_blue(whichset)
-        for i, ctx, ctx_mask in zip(range(len(ctxs)), ctxs, ctx_masks):
-            print 'sampling %d/%d'%(i,len(ctxs))
+        n_videos = len(engine.val_ids if whichset == 'val' else engine.test_ids)
+        if f_beam is not None and options['beam_search']:
+            # beam search decode_batch_size videos per sess.run, inside the graph
+            for i, (_, ctxs, ctx_masks) in enumerate(engine.iterate_data_for_blue(whichset, decode_batch_size)):
+                print 'sampling %d/%d'%(i*decode_batch_size,n_videos)
+                rval = model.gen_sample_graph(sess, f_beam, ctxs, ctx_masks, maxlen=MAXLEN)
+                for sample, score in rval:
+                    samples.append(sample[np.argmin(score)])
+            return seqs2words(samples, engine)
+        if f_init_batch is not None and options['beam_search']:
+            # beam search decode_batch_size videos per f_next call
+            for i, (_, ctxs, ctx_masks) in enumerate(engine.iterate_data_for_blue(whichset, decode_batch_size)):
+                print 'sampling %d/%d'%(i*decode_batch_size,n_videos)
+                rval = model.gen_sample_batch(sess, f_init_batch, f_next_batch,
+                    ctxs, ctx_masks, options, k=5, maxlen=MAXLEN)
+                for sample, score in rval:
+                    samples.append(sample[np.argmin(score)])
+            return seqs2words(samples, engine)
+        for i, (_, ctx, ctx_mask) in enumerate(engine.iterate_data_for_blue(whichset)):
+            print 'sampling %d/%d'%(i,n_videos)
             stochastic = not options['beam_search']
             if stochastic:
                 kbeam = 1
@@ -90,14 +128,15 @@ def generate_sample_gpu_single_process(sess,
                 kbeam = 5
             sample, score, _, _ = model.gen_sample(sess,
                 None, f_init, f_next, ctx, ctx_mask, options,
-                k=kbeam, maxlen=MAXLEN, stochastic=stochastic)
+                k=kbeam, maxlen=MAXLEN, stochastic=stochastic,
+                restrict_voc=get_restrict_voc(engine, options, ctx, ctx_mask))
             if not stochastic:
                 sidx = np.argmin(score)
                 sample = sample[sidx]
             else:
                 sample = [sample]
             samples.append(sample)
-        samples = _seqs2words(samples)
+        samples = seqs2words(samples, engine)
         return samples
 
     samples_valid = None
@@ -119,17 +158,156 @@ def generate_sample_gpu_single_process(sess,
         samples_test = build_sample_pairs(samples_test, engine.test_ids)
     return samples_valid, samples_test
 
+def start_cpu_decoders(options, n_process, params):
+    '''
+    Start the decoder processes of the on_cpu path of compute_score, returned as the
+    (processes, queue, rqueue, shared_params) handles compute_score takes back on the next
+    validation. params (numpy, as init_params gives them) only sets the shapes of the shared
+    memory the parameters are passed through. Start them before any session of the parent
+    exists, a forked process must not inherit its CUDA context.
+    '''
+    version = Value('i', 0)
+    shared = OrderedDict()
+    for name, value in params.iteritems():
+        assert value.dtype == np.float32, '%s is %s'%(name, value.dtype)
+        shared[name] = np.frombuffer(RawArray('f', value.size), dtype=np.float32).reshape(value.shape)
+        shared[name][...] = value
+    shared_params = (version, shared)
+    queue = Queue()
+    rqueue = Queue()
+    processes = [Process(target=cpu_decoder, args=(options, shared_params, queue, rqueue))
+                 for _ in xrange(n_process)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    return processes, queue, rqueue, shared_params
+
+def stop_cpu_decoders(processes, queue):
+    for _ in processes:
+        queue.put(None)
+    for process in processes:
+        process.join()
+
+def cpu_decoder(options, shared_params, queue, rqueue):
+    '''
+    Decoder process: takes (version, whichset, video index, vidID) from queue and puts
+    (whichset, video index, sample) in rqueue, reloading the parameters from shared memory
+    when a job of a new version comes. None stops it. The video comes by its vidID: the
+    engine of the process shuffles its ids with another rng state than the parent's.
+    '''
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    version, params = shared_params
+    try:
+        with tf.Graph().as_default():
+            engine = data_engine.engine_from_options(options)
+            options = dict(options)
+            options['ctx_dim'] = engine.ctx_dim
+            options['vocab_size'] = engine.vocab_size
+            model = Model()
+            tfparams = utils.init_tfparams(params)
+            use_noise = tf.Variable(False, dtype=tf.bool, trainable=False, name="use_noise")
+            CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+                BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER = train.sampler_placeholders(
+                    options['ctx_frames'], options['ctx_dim'], options['lstm_dim'])
+            VOC_SAMPLER = train.voc_sampler_placeholder(options['vocab_size']) \
+                if options.get('restrict_voc', 0) > 0 else None
+            f_init, f_next = model.build_sampler(tfparams, options, use_noise,
+                                    CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER,
+                                    TO_INIT_STATE_SAMPLER, BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER,
+                                    pctx_sampler=PCTX_SAMPLER, voc_sampler=VOC_SAMPLER)
+            # one thread each, the processes share the cores
+            sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=1,
+                                                    inter_op_parallelism_threads=1))
+            sess.run(tf.global_variables_initializer())
+            sess.graph.finalize()
+            stochastic = not options['beam_search']
+            kbeam = 1 if stochastic else 5
+            loaded = -1
+            while True:
+                job = queue.get()
+                if job is None:
+                    break
+                job_version, whichset, idx, vidID = job
+                if job_version != loaded:
+                    for name, tfparam in tfparams.iteritems():
+                        tfparam.load(params[name], sess)
+                    loaded = job_version
+                ctx = engine.get_video_features(vidID)
+                ctx_mask = engine.get_ctx_mask(ctx)
+                sample, score, _, _ = model.gen_sample(sess,
+                    None, f_init, f_next, ctx, ctx_mask, options,
+                    k=kbeam, maxlen=MAXLEN, stochastic=stochastic,
+                    restrict_voc=get_restrict_voc(engine, options, ctx, ctx_mask))
+                if not stochastic:
+                    sample = sample[np.argmin(score)]
+                rqueue.put((whichset, idx, sample))
+            sess.close()
+    except Exception:
+        rqueue.put(traceback.format_exc())
+
+def generate_sample_cpu(sess, tfparams, options, engine, queue, rqueue, shared_params,
+        save_dir='./samples/', whichset='both'):
+    # copy the current parameters to the decoders and spread the videos over them
+    version, params = shared_params
+    for name, value in sess.run(tfparams).iteritems():
+        params[name][...] = value
+    version.value += 1
+
+    ids = OrderedDict()
+    if whichset == 'val' or whichset == 'both':
+        ids['val'] = engine.val_ids
+    if whichset == 'test' or whichset == 'both':
+        ids['test'] = engine.test_ids
+    samples = OrderedDict()
+    n_jobs = 0
+    for name, vidIDs in ids.iteritems():
+        samples[name] = [None] * len(vidIDs)
+        for idx, vidID in enumerate(vidIDs):
+            queue.put((version.value, name, idx, vidID))
+            n_jobs += 1
+    for i in xrange(n_jobs):
+        result = rqueue.get()
+        if isinstance(result, str):
+            raise RuntimeError('decoder process failed:\n'+result)
+        name, idx, sample = result
+        samples[name][idx] = sample
+        if np.mod(i + 1, 100) == 0:
+            print 'sampled %d/%d'%(i + 1, n_jobs)
+
+    samples_valid = None
+    samples_test = None
+    if 'val' in samples:
+        samples_valid = seqs2words(samples['val'], engine)
+        with open(save_dir+'valid_samples.txt', 'w') as f:
+            print >>f, '\n'.join(samples_valid)
+        samples_valid = build_sample_pairs(samples_valid, engine.val_ids)
+    if 'test' in samples:
+        samples_test = seqs2words(samples['test'], engine)
+        with open(save_dir+'test_samples.txt', 'w') as f:
+            print >>f, '\n'.join(samples_test)
+        samples_test = build_sample_pairs(samples_test, engine.test_ids)
+    return samples_valid, samples_test
+
 def compute_score(sess,
         model_type, model_archive, options, engine, save_dir,
         beam, n_process,
         whichset='both', on_cpu=True,
         processes=None, queue=None, rqueue=None, shared_params=None,
         one_time=False, metric=None,
-        f_init=None, f_next=None, model=None):
+        f_init=None, f_next=None, model=None,
+        f_init_batch=None, f_next_batch=None, decode_batch_size=1, f_beam=None,
+        tfparams=None, scorer_service=None, scoring='coco'):
 
     assert metric != 'perplexity'
     if on_cpu:
-        raise NotImplementedError()
+        # decode on the pool of start_cpu_decoders, kept across validations: started here the
+        # processes would fork the live session
+        assert tfparams is not None
+        assert processes is not None, 'start_cpu_decoders before the session for on_cpu'
+        samples_valid, samples_test = generate_sample_cpu(sess, tfparams, options, engine,
+            queue, rqueue, shared_params,
+            save_dir=save_dir,
+            whichset=whichset)
     else:
         assert model is not None
         samples_valid, samples_test = generate_sample_gpu_single_process(sess,
@@ -137,9 +315,12 @@ def compute_score(sess,
             engine, model, f_init, f_next,
             save_dir=save_dir,
             beam=beam,
-            whichset=whichset)
+            whichset=whichset,
+            f_init_batch=f_init_batch, f_next_batch=f_next_batch,
+            decode_batch_size=decode_batch_size, f_beam=f_beam)
         
-    valid_score, test_score = score_with_cocoeval(samples_valid, samples_test, engine)
+    valid_score, test_score = score_with_cocoeval(samples_valid, samples_test, engine,
+                                                  scorer_service=scorer_service, scoring=scoring)
     scores_final = {}
     scores_final['valid'] = valid_score
     scores_final['test'] = test_score
@@ -7,6 +7,27 @@ import sys
 from data_engine import prepare_data
 import utils
 
+def beam_candidates(hyp_scores, next_p, n_best):
+    '''
+    the n_best cheapest one word extensions of the live hypotheses
+    hyp_scores: (m,) cost of every live hypothesis
+    next_p: (m, n_words) next word probabilities
+
+    returns the hypothesis, the word and the cost of every extension, cheapest first
+    '''
+    voc_size = next_p.shape[1]
+    if n_best < voc_size:
+        # the n_best cheapest overall are among the n_best most likely words of every hypothesis,
+        # so only m*n_best costs are computed and sorted
+        word_indices = np.argpartition(-next_p, n_best - 1, axis=1)[:, :n_best]
+    else:
+        word_indices = np.tile(np.arange(voc_size), (next_p.shape[0], 1))
+    trans_indices = np.repeat(np.arange(next_p.shape[0]), word_indices.shape[1])
+    word_indices = word_indices.ravel()
+    cand_flat = hyp_scores[trans_indices] - np.log(next_p[trans_indices, word_indices])
+    ranks_flat = np.argsort(cand_flat)[:n_best]
+    return trans_indices[ranks_flat], word_indices[ranks_flat], cand_flat[ranks_flat]
+
 class Model(object):
 
     def __init__(self):
@@ -33,7 +54,12 @@ class Model(object):
         params = self.layers.get_layer('ff')[0](options, params, prefix='ff_logit', nin=options['word_dim'], nout=options['vocab_size'])
         return params
 
-    def build_model(self, tfparams, options, x, mask, ctx, ctx_mask):
+    def build_model(self, tfparams, options, x, mask, ctx, ctx_mask, ctx_idx=None, word_counts=None):
+        # ctx_idx: (m,) row of ctx of every caption when captions share contexts,
+        # ctx and ctx_mask then hold every video once
+        # word_counts: (n_words,) training occurrences of every word, what the sampled softmax of
+        # options['softmax_samples'] > 0 draws from
+        # returns use_noise, the exact cost (m,) and [probs, alphas, betas, cost to train on]
         use_noise = tf.Variable(False, dtype=tf.bool, trainable=False, name="use_noise")
         x_shape = tf.shape(x)
         n_timesteps = x_shape[0]
@@ -60,6 +86,10 @@ class Model(object):
         with tf.name_scope("init_memory"):
             init_memory = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_memory', activ='tanh') # (64,512)
 
+        if ctx_idx is not None:
+            init_state = tf.gather(init_state, ctx_idx)
+            init_memory = tf.gather(init_memory, ctx_idx)
+
         # hstltm = self.layers.build_hlstm(['bo_lstm','to_lstm'], inputs, n_timesteps, init_state, init_memory)
         with tf.name_scope("bo_lstm"):
             bo_lstm = self.layers.get_layer('lstm_cond')[1](tfparams, emb, options,
@@ -68,7 +98,8 @@ class Model(object):
                                                             one_step=False,
                                                             init_state=init_state,
                                                             init_memory=init_memory,
-                                                            use_noise=use_noise)
+                                                            use_noise=use_noise,
+                                                            context_idx=ctx_idx)
         with tf.name_scope("to_lstm"):
             to_lstm = self.layers.get_layer('lstm')[1](tfparams, bo_lstm[0],
                                                        mask=mask,
@@ -94,50 +125,52 @@ class Model(object):
         logit = utils.tanh(logit)   # (t,64,512)
         if options['use_dropout']:
             logit = self.layers.dropout_layer(logit, use_noise)
+        readout = logit # (t,64,512)
         # (t,m,n_words)
         logit = self.layers.get_layer('ff')[1](tfparams, logit, options, prefix='ff_logit', activ='linear') # (t,64,512)*(512,vocab_size) = (t,64,vocab_size)
         logit_shape = tf.shape(logit)
         # (t*m, n_words)
-        probs = tf.nn.softmax(tf.reshape(logit,[logit_shape[0] * logit_shape[1], logit_shape[2]]))    # (t*64, vocab_size)
+        logit = tf.reshape(logit,[logit_shape[0] * logit_shape[1], logit_shape[2]])
+        # only computed when fetched, the cost does not need it
+        probs = tf.nn.softmax(logit)    # (t*64, vocab_size)
         # cost
         x_flat = tf.reshape(x,[x_shape[0] * x_shape[1]])  # (t*m,)
-        x_flat_shape = tf.shape(x_flat)
-        gather_indices = tf.stack([tf.range(x_flat_shape[0]), x_flat], axis=1)  # (t*m,2)
-        cost = -tf.log(tf.gather_nd(probs,gather_indices) + 1e-8) # (t*m,) : pick probs of each word in each timestep 
+        cost = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=x_flat, logits=logit) # (t*m,) : -log prob of each word in each timestep
         cost = tf.reshape(cost,[x_shape[0], x_shape[1]])    # (t,m)
         cost = tf.reduce_sum((cost * mask), axis=0) # (m,) : sum across all timesteps for each element in batch
-        extra = [probs, alphas, betas]
+        softmax_samples = options.get('softmax_samples', 0)
+        if softmax_samples > 0:
+            # sampled softmax: the targets against softmax_samples words drawn by training frequency,
+            # without the (t*m, n_words) logits
+            labels = tf.cast(x_flat[:, None], tf.int64)    # (t*m,1)
+            sampled_values = tf.nn.fixed_unigram_candidate_sampler(labels, num_true=1,
+                                num_sampled=softmax_samples, unique=True,
+                                range_max=options['vocab_size'], distortion=0.75,
+                                unigrams=[float(count) + 1. for count in word_counts])
+            train_cost = tf.nn.sampled_softmax_loss(weights=tf.transpose(tfparams['ff_logit_W']),
+                                biases=tfparams['ff_logit_b'], labels=labels,
+                                inputs=tf.reshape(readout, [-1, options['word_dim']]),
+                                num_sampled=softmax_samples, num_classes=options['vocab_size'],
+                                sampled_values=sampled_values)  # (t*m,)
+            train_cost = tf.reduce_sum(tf.reshape(train_cost, [x_shape[0], x_shape[1]]) * mask, axis=0)  # (m,)
+        else:
+            train_cost = cost
+        extra = [probs, alphas, betas, train_cost]
         return use_noise, cost, extra
 
-    def build_sampler(self, tfparams, options, use_noise, ctx0, ctx_mask, x,
-                    bo_init_state_sampler, to_init_state_sampler, bo_init_memory_sampler, to_init_memory_sampler, mode=None):
-        # ctx: # frames x ctx_dim
-        ctx_ = ctx0
-        counts = tf.reduce_sum(ctx_mask, axis=-1)   # scalar
-
-        ctx = ctx_
-        ctx_mean = tf.reduce_sum(ctx, axis=0) / counts  # (2048,)
-        ctx = tf.expand_dims(ctx, 0)  # (1,28,2048)
-
-        # initial state/cell
-        bo_init_state = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_state', activ='tanh')    # (512,)
-        bo_init_memory = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_memory', activ='tanh')  # (512,)
-        to_init_state = tf.zeros(shape=(options['lstm_dim'],), dtype=tf.float32)  # DOUBT : constant or not? # (512,)
-        to_init_memory = tf.zeros(shape=(options['lstm_dim'],), dtype=tf.float32)    # (512,)
-        init_state = [bo_init_state, to_init_state]
-        init_memory = [bo_init_memory, to_init_memory]
-
-        print 'building f_init...',
-        f_init = [ctx0] + init_state + init_memory
-        print 'done'
-
-        init_state = [bo_init_state_sampler, to_init_state_sampler]
-        init_memory = [bo_init_memory_sampler, to_init_memory_sampler]
-
+    def sampler_step(self, tfparams, options, use_noise, x, ctx, init_state, init_memory,
+                     mode=None, pctx=None, ctx_idx=None, voc=None):
+        '''
+        one decoding step of m hypotheses
+        x: (m,) previous words, -1 for the first word
+        ctx: (n,28,2048) with n == 1, or n videos and ctx_idx (m,) the video of every hypothesis
+        init_state, init_memory: [(m,512), (m,512)] of bo_lstm and to_lstm
+        voc: (v,) word ids to compute the probabilities of, None for every word
+        returns next_probs (m,n_words) or (m,v), next_state and next_memory
+        '''
         # # if it's the first word, embedding should be all zero
-        emb = tf.cond(tf.reduce_any(x[:, None] < 0),
-                        lambda: tf.zeros(shape=(1,tfparams['Wemb'].shape[1]), dtype=tf.float32),
-                        lambda: tf.nn.embedding_lookup(tfparams['Wemb'], x))    # (m,512)
+        emb = tf.nn.embedding_lookup(tfparams['Wemb'], tf.maximum(x, 0))    # (m,512)
+        emb *= tf.cast(tf.greater_equal(x, 0), tf.float32)[:, None]
 
         bo_lstm = self.layers.get_layer('lstm_cond')[1](tfparams, emb, options,
                                                         prefix='bo_lstm',
@@ -146,7 +179,9 @@ class Model(object):
                                                         init_state=init_state[0],
                                                         init_memory=init_memory[0],
                                                         use_noise=use_noise,
-                                                        mode=mode)
+                                                        mode=mode,
+                                                        context_idx=ctx_idx,
+                                                        pctx=pctx)
         to_lstm = self.layers.get_layer('lstm')[1](tfparams, bo_lstm[0],
                                                    mask=None,
                                                    one_step=True,
@@ -157,29 +192,75 @@ class Model(object):
         next_state = [bo_lstm[0], to_lstm[0]]
         next_memory = [bo_lstm[1], to_lstm[0]]
 
-        bo_lstm_h = bo_lstm[0]  # (1,512)
-        to_lstm_h = to_lstm[0]  # (1,512)
-        alphas = bo_lstm[2] # (1,28)
-        ctxs = bo_lstm[3]   # (1,2048)
-        betas = bo_lstm[4]  # (1,)
+        bo_lstm_h = bo_lstm[0]  # (m,512)
+        to_lstm_h = to_lstm[0]  # (m,512)
+        alphas = bo_lstm[2] # (m,28)
+        ctxs = bo_lstm[3]   # (m,2048)
+        betas = bo_lstm[4]  # (m,)
         if options['use_dropout']:
             bo_lstm_h = self.layers.dropout_layer(bo_lstm_h, use_noise)
             to_lstm_h = self.layers.dropout_layer(to_lstm_h, use_noise)
         # compute word probabilities
-        logit = self.layers.get_layer('ff')[1](tfparams, bo_lstm_h, options, prefix='ff_logit_bo', activ='linear')  # (1,512)*(512,512) = (1,512)
+        logit = self.layers.get_layer('ff')[1](tfparams, bo_lstm_h, options, prefix='ff_logit_bo', activ='linear')  # (m,512)*(512,512) = (m,512)
         if options['prev2out']:
             logit += emb
         if options['ctx2out']:
-            to_lstm_h *= (1-betas[:, None])  # (1,512)*(1,1) = (1,512)
-            ctxs_beta = self.layers.get_layer('ff')[1](tfparams, ctxs, options, prefix='ff_logit_ctx', activ='linear')  # (1,2048)*(2048,512) = (1,512)
-            ctxs_beta += self.layers.get_layer('ff')[1](tfparams, to_lstm_h, options, prefix='ff_logit_to', activ='linear') # (1,512)+((1,512)*(512,512)) = (1,512)
+            to_lstm_h *= (1-betas[:, None])  # (m,512)*(m,1) = (m,512)
+            ctxs_beta = self.layers.get_layer('ff')[1](tfparams, ctxs, options, prefix='ff_logit_ctx', activ='linear')  # (m,2048)*(2048,512) = (m,512)
+            ctxs_beta += self.layers.get_layer('ff')[1](tfparams, to_lstm_h, options, prefix='ff_logit_to', activ='linear') # (m,512)+((m,512)*(512,512)) = (m,512)
             logit += ctxs_beta
-        logit = utils.tanh(logit)   # (1,512)
+        logit = utils.tanh(logit)   # (m,512)
         if options['use_dropout']:
             logit = self.layers.dropout_layer(logit, use_noise)
-        # (1,n_words)
-        logit = self.layers.get_layer('ff')[1](tfparams, logit, options, prefix='ff_logit', activ='linear') # (1,512)*(512,vocab_size) = (1,vocab_size)
+        if voc is not None:
+            # (m,v): only the columns of the words of voc, renormalized over them by the softmax
+            logit = tf.matmul(logit, tf.gather(tfparams['ff_logit_W'], voc, axis=1)) + \
+                tf.gather(tfparams['ff_logit_b'], voc)  # (m,512)*(512,v) = (m,v)
+        else:
+            # (m,n_words)
+            logit = self.layers.get_layer('ff')[1](tfparams, logit, options, prefix='ff_logit', activ='linear') # (m,512)*(512,vocab_size) = (m,vocab_size)
         next_probs = tf.nn.softmax(logit)
+        return next_probs, next_state, next_memory
+
+    def build_sampler(self, tfparams, options, use_noise, ctx0, ctx_mask, x,
+                    bo_init_state_sampler, to_init_state_sampler, bo_init_memory_sampler, to_init_memory_sampler, mode=None,
+                    pctx_sampler=None, voc_sampler=None):
+        # ctx: # frames x ctx_dim
+        # pctx_sampler: when given, f_init also returns the projected context (# frames x ctx_dim)
+        # which f_next takes through pctx_sampler instead of projecting ctx at every step
+        # voc_sampler: when given, f_next returns the probabilities of these words only and
+        # samples their positions in it, see gen_sample restrict_voc
+        ctx_ = ctx0
+        counts = tf.reduce_sum(ctx_mask, axis=-1)   # scalar
+
+        ctx = ctx_
+        ctx_mean = tf.reduce_sum(ctx, axis=0) / counts  # (2048,)
+        ctx = tf.expand_dims(ctx, 0)  # (1,28,2048)
+
+        # initial state/cell
+        bo_init_state = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_state', activ='tanh')    # (512,)
+        bo_init_memory = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_memory', activ='tanh')  # (512,)
+        to_init_state = tf.zeros(shape=(options['lstm_dim'],), dtype=tf.float32)  # DOUBT : constant or not? # (512,)
+        to_init_memory = tf.zeros(shape=(options['lstm_dim'],), dtype=tf.float32)    # (512,)
+        init_state = [bo_init_state, to_init_state]
+        init_memory = [bo_init_memory, to_init_memory]
+
+        print 'building f_init...',
+        f_init = [ctx0] + init_state + init_memory
+        if pctx_sampler is not None:
+            pctx0 = tf.matmul(ctx0, tfparams['bo_lstm_Wc_att']) + tfparams['bo_lstm_b_att']  # (28,2048)*(2048,2048)+(2048,) = (28,2048)
+            f_init += [pctx0]
+            pctx = tf.expand_dims(pctx_sampler, 0)  # (1,28,2048)
+        else:
+            pctx = None
+        print 'done'
+
+        init_state = [bo_init_state_sampler, to_init_state_sampler]
+        init_memory = [bo_init_memory_sampler, to_init_memory_sampler]
+
+        next_probs, next_state, next_memory = self.sampler_step(tfparams, options, use_noise, x, ctx,
+                                                                init_state, init_memory, mode=mode, pctx=pctx,
+                                                                voc=voc_sampler)
         # next_sample = trng.multinomial(pvals=next_probs).argmax(1)    # INCOMPLETE , DOUBT : why is multinomial needed?
         next_sample = tf.multinomial(next_probs,1) # draw samples with given probabilities (1,1)
         next_sample_shape = tf.shape(next_sample)
@@ -190,13 +271,139 @@ class Model(object):
         print 'done'
         return f_init, f_next
 
+    def build_batch_sampler(self, tfparams, options, use_noise, ctx0, ctx_mask, x, ctx_idx, pctx_sampler,
+                    bo_init_state_sampler, to_init_state_sampler, bo_init_memory_sampler, to_init_memory_sampler, mode=None):
+        # ctx: # videos x # frames x ctx_dim
+        # f_init returns the initial states of every video and its projected context, which f_next
+        # takes through pctx_sampler; ctx_idx is the video of every hypothesis advanced by f_next
+        counts = tf.reduce_sum(ctx_mask, axis=-1)   # (n,)
+        ctx_mean = tf.reduce_sum(ctx0, axis=1) / counts[:, None]  # (n,2048)
+
+        # initial state/cell
+        bo_init_state = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_state', activ='tanh')    # (n,512)
+        bo_init_memory = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_memory', activ='tanh')  # (n,512)
+        to_init_state = tf.zeros_like(bo_init_state)  # (n,512)
+        to_init_memory = tf.zeros_like(bo_init_memory)    # (n,512)
+        pctx0 = utils.batch_matmul(ctx0, tfparams['bo_lstm_Wc_att']) + tfparams['bo_lstm_b_att']  # (n,28,2048)*(2048,2048)+(2048,) = (n,28,2048)
+
+        print 'building f_init_batch...',
+        f_init = [bo_init_state, to_init_state, bo_init_memory, to_init_memory, pctx0]
+        print 'done'
+
+        init_state = [bo_init_state_sampler, to_init_state_sampler]
+        init_memory = [bo_init_memory_sampler, to_init_memory_sampler]
+
+        next_probs, next_state, next_memory = self.sampler_step(tfparams, options, use_noise, x, ctx0,
+                                                                init_state, init_memory, mode=mode,
+                                                                pctx=pctx_sampler, ctx_idx=ctx_idx)
+        print 'building f_next_batch...',
+        f_next = [next_probs] + next_state + next_memory
+        print 'done'
+        return f_init, f_next
+
+    def build_beam_search(self, tfparams, options, use_noise, ctx0, ctx_mask, k=5, mode=None):
+        '''
+        beam search of a batch of videos inside the graph, one sess.run decodes all of them
+        ctx0: (n,28,2048) (n, f, dim_ctx)
+        ctx_mask: (n,28) (n, f)
+        the number of steps is fed through beam_maxlen, 30 by default
+
+        returns f_beam = [samples (n,2k,maxlen), scores (n,2k), lengths (n,2k)]: per video the
+        finished hypotheses in the order they ended, then the ones still live at maxlen.
+        Unused slots have an infinite score.
+        '''
+        maxlen = tf.placeholder_with_default(30, shape=(), name='beam_maxlen')
+        n_videos = tf.shape(ctx0)[0]
+        n_rows = n_videos * k
+        inf = np.float32(np.inf)
+
+        counts = tf.reduce_sum(ctx_mask, axis=-1)   # (n,)
+        ctx_mean = tf.reduce_sum(ctx0, axis=1) / counts[:, None]  # (n,2048)
+        bo_init_state = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_state', activ='tanh')    # (n,512)
+        bo_init_memory = self.layers.get_layer('ff')[1](tfparams, ctx_mean, options, prefix='ff_memory', activ='tanh')  # (n,512)
+        pctx0 = utils.batch_matmul(ctx0, tfparams['bo_lstm_Wc_att']) + tfparams['bo_lstm_b_att']  # (n,28,2048)
+
+        # k beams per video, row i is beam i % k of video i // k
+        ctx_idx = tf.reshape(tf.tile(tf.range(n_videos)[:, None], [1, k]), [-1])   # (n*k,)
+        bo_init_state = tf.gather(bo_init_state, ctx_idx)    # (n*k,512)
+        bo_init_memory = tf.gather(bo_init_memory, ctx_idx)  # (n*k,512)
+        to_init_state = tf.zeros_like(bo_init_state)
+        to_init_memory = tf.zeros_like(bo_init_memory)
+
+        # only the first beam of every video is live before the first word
+        init_scores = tf.tile(tf.constant([[0.] + [inf] * (k - 1)], dtype=tf.float32), [n_videos, 1])  # (n,k)
+        init_seqs = tf.zeros(tf.stack([n_videos, k, maxlen]), dtype=tf.int32)    # (n,k,maxlen)
+
+        def cond(t, x, bo_state, to_state, bo_memory, to_memory,
+                 live_seqs, live_scores, fin_seqs, fin_scores, fin_lens, n_dead):
+            return tf.logical_and(t < maxlen, tf.reduce_any(tf.is_finite(live_scores)))
+
+        def body(t, x, bo_state, to_state, bo_memory, to_memory,
+                 live_seqs, live_scores, fin_seqs, fin_scores, fin_lens, n_dead):
+            next_probs, next_state, next_memory = self.sampler_step(tfparams, options, use_noise, x, ctx0,
+                                                                    [bo_state, to_state], [bo_memory, to_memory],
+                                                                    mode=mode, pctx=pctx0, ctx_idx=ctx_idx)
+            voc_size = tf.shape(next_probs)[1]
+            cand_scores = live_scores[:, :, None] - tf.log(tf.reshape(next_probs, tf.stack([n_videos, k, voc_size])))
+            cand_flat = tf.reshape(cand_scores, tf.stack([n_videos, k * voc_size]))    # (n,k*n_words)
+            neg_costs, ranks_flat = tf.nn.top_k(-cand_flat, k)  # cheapest first
+            costs = -neg_costs  # (n,k)
+            trans_indices = ranks_flat // voc_size  # beam every candidate extends
+            word_indices = ranks_flat % voc_size
+
+            # as in gen_sample the beam narrows by one for every finished hypothesis
+            valid = tf.logical_and(tf.range(k)[None, :] < (k - n_dead)[:, None], tf.is_finite(costs))
+            finished = tf.logical_and(valid, tf.equal(word_indices, 0))
+            live = tf.logical_and(valid, tf.not_equal(word_indices, 0))
+
+            rows = tf.reshape(trans_indices + tf.range(n_videos)[:, None] * k, [-1])  # (n*k,)
+            cand_seqs = tf.reshape(tf.gather(tf.reshape(live_seqs, tf.stack([n_rows, maxlen])), rows),
+                                   tf.stack([n_videos, k, maxlen]))
+            cand_seqs += word_indices[:, :, None] * tf.one_hot(t, maxlen, dtype=tf.int32)
+
+            # move the finished candidates to the next free slots of fin_seqs
+            finished_f = tf.cast(finished, tf.float32)
+            slots = n_dead[:, None] + tf.cast(tf.cumsum(finished_f, axis=1), tf.int32) - 1
+            to_slot = tf.transpose(tf.one_hot(slots, k) * finished_f[:, :, None], [0, 2, 1])  # (n,slot,candidate)
+            fin_seqs += tf.cast(tf.matmul(to_slot, tf.cast(cand_seqs, tf.float32)), tf.int32)
+            filled = tf.reduce_sum(to_slot, axis=2) > 0
+            fin_costs = tf.reduce_sum(to_slot * tf.where(finished, costs, tf.zeros_like(costs))[:, None, :], axis=2)
+            fin_scores = tf.where(filled, fin_costs, fin_scores)
+            fin_lens = tf.where(filled, tf.fill(tf.shape(fin_lens), t + 1), fin_lens)
+            n_dead += tf.reduce_sum(tf.cast(finished, tf.int32), axis=1)
+
+            live_scores = tf.where(live, costs, tf.fill(tf.shape(costs), inf))
+            states = [tf.gather(state, rows) for state in next_state + next_memory]
+            return [t + 1, tf.reshape(word_indices, [-1])] + states + \
+                   [cand_seqs, live_scores, fin_seqs, fin_scores, fin_lens, n_dead]
+
+        loop_vars = [tf.constant(0), -1 * tf.ones(tf.stack([n_rows]), dtype=tf.int32),
+                     bo_init_state, to_init_state, bo_init_memory, to_init_memory,
+                     init_seqs, init_scores, init_seqs, tf.fill(tf.shape(init_scores), inf),
+                     tf.zeros_like(init_scores, dtype=tf.int32), tf.zeros(tf.stack([n_videos]), dtype=tf.int32)]
+        state_shape = tf.TensorShape([None, options['lstm_dim']])
+        seqs_shape = tf.TensorShape([None, k, None])
+        scores_shape = tf.TensorShape([None, k])
+        shape_invariants = [tf.TensorShape([]), tf.TensorShape([None])] + [state_shape] * 4 + \
+                           [seqs_shape, scores_shape, seqs_shape, scores_shape, scores_shape, tf.TensorShape([None])]
+        print 'building f_beam...',
+        rval = tf.while_loop(cond, body, loop_vars, shape_invariants=shape_invariants, name='beam_search')
+        t, live_seqs, live_scores, fin_seqs, fin_scores, fin_lens = [rval[0]] + rval[6:11]
+        f_beam = [tf.concat([fin_seqs, live_seqs], axis=1),
+                  tf.concat([fin_scores, live_scores], axis=1),
+                  tf.concat([fin_lens, tf.fill(tf.shape(fin_lens), t)], axis=1)]
+        print 'done'
+        return f_beam
+
     def gen_sample(self, sess, tfparams, f_init, f_next, ctx0, ctx_mask, options,
-                   k=1, maxlen=30, stochastic=False, restrict_voc=False):
+                   k=1, maxlen=30, stochastic=False, restrict_voc=None):
         '''
         ctx0: (28,2048) (f, dim_ctx)
         ctx_mask: (28,) (f, )
 
-        restrict_voc: set the probability of outofvoc words with 0, renormalize
+        restrict_voc: (v,) word ids to decode over, with 0 (<eos>), the other words get
+        probability 0 and these are renormalized. f_next must come from build_sampler with
+        voc_sampler. None for the whole vocabulary
         '''
         if k > 1:
             assert not stochastic, 'Beam search does not support stochastic sampling'
@@ -209,12 +416,11 @@ class Model(object):
         live_k = 1
         dead_k = 0
 
-        hyp_samples = [[]] * live_k
+        # tokens of the live hypotheses, row i of the states is hypothesis i
+        hyp_samples = np.zeros((live_k, maxlen), dtype='int32')
         hyp_scores = np.zeros(live_k).astype('float32')
-        hyp_states = []
-        hyp_memories = []
 
-        # [(28,2048),(512,),(512,),(512,),(512,)]
+        # [(28,2048),(512,),(512,),(512,),(512,)] + [(28,2048)] with a cached context projection
         rval = sess.run(f_init, feed_dict={
                     "ctx_sampler:0": ctx0,
                     "ctx_mask_sampler:0": ctx_mask
@@ -224,6 +430,11 @@ class Model(object):
         next_state = []
         next_memory = []
         n_layers_lstm = 2
+        feed_dict = {"ctx_sampler:0": ctx0}
+        if len(rval) > 1 + 2 * n_layers_lstm:
+            feed_dict["pctx_sampler:0"] = rval[1 + 2 * n_layers_lstm]
+        if restrict_voc is not None:
+            feed_dict["voc_sampler:0"] = restrict_voc
 
         for lidx in xrange(n_layers_lstm):
             next_state.append(rval[1 + lidx])
@@ -236,21 +447,18 @@ class Model(object):
             # return [(1, vocab_size), (1,), (1, 512), (1, 512), (1, 512), (1, 512)]
             # next_w: vector (1,)
             # ctx: matrix   (28, 2048)
-            # ctx_mask: vector  (28,)
+            # pctx: matrix  (28, 2048) if cached
             # next_state: [matrix] [(1, 512), (1, 512)]
             # next_memory: [matrix] [(1, 512), (1, 512)]
-            rval = sess.run(f_next, feed_dict={
+            feed_dict.update({
                         "x_sampler:0": next_w,
-                        "ctx_sampler:0": ctx0,
-                        "ctx_mask_sampler:0": ctx_mask,
                         'bo_init_state_sampler:0': next_state[0],
                         'to_init_state_sampler:0': next_state[1],
                         'bo_init_memory_sampler:0': next_memory[0],
                         'to_init_memory_sampler:0': next_memory[1]
                     })
-            next_p = rval[0]
-            if restrict_voc:
-                raise NotImplementedError()
+            rval = sess.run(f_next, feed_dict=feed_dict)
+            next_p = rval[0]  # (live_k, vocab_size) or (live_k, v) over restrict_voc
             next_w = rval[1]  # already argmax sorted
             next_state = []
             for lidx in xrange(n_layers_lstm):
@@ -259,88 +467,154 @@ class Model(object):
             for lidx in xrange(n_layers_lstm):
                 next_memory.append(rval[2 + n_layers_lstm + lidx])
             if stochastic:
-                sample.append(next_w[0])  # take the most likely one
                 sample_score += next_p[0, next_w[0]]
+                if restrict_voc is not None:
+                    next_w = restrict_voc[next_w]
+                sample.append(next_w[0])  # take the most likely one
                 if next_w[0] == 0:
                     break
             else:
                 # the first run is (1,vocab_size)
-                cand_scores = hyp_scores[:, None] - np.log(next_p)
-                cand_flat = cand_scores.flatten()
-                ranks_flat = cand_flat.argsort()[:(k - dead_k)]
-
-
-                voc_size = next_p.shape[1]
-                trans_indices = ranks_flat / voc_size  # index of row
-                word_indices = ranks_flat % voc_size  # index of col
-                costs = cand_flat[ranks_flat]
-
-                new_hyp_samples = []
-                new_hyp_scores = np.zeros(k - dead_k).astype('float32')
-                new_hyp_states = []
-                for lidx in xrange(n_layers_lstm):
-                    new_hyp_states.append([])
-                new_hyp_memories = []
-                for lidx in xrange(n_layers_lstm):
-                    new_hyp_memories.append([])
-
-                for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                    new_hyp_samples.append(hyp_samples[ti] + [wi])
-                    new_hyp_scores[idx] = copy.copy(costs[idx])
-                    for lidx in xrange(n_layers_lstm):
-                        new_hyp_states[lidx].append(copy.copy(next_state[lidx][ti]))
-                    for lidx in xrange(n_layers_lstm):
-                        new_hyp_memories[lidx].append(copy.copy(next_memory[lidx][ti]))
+                trans_indices, word_indices, costs = beam_candidates(hyp_scores, next_p, k - dead_k)
+                if restrict_voc is not None:
+                    word_indices = restrict_voc[word_indices]
+                new_hyp_samples = hyp_samples[trans_indices]
+                new_hyp_samples[:, ii] = word_indices
 
                 # check the finished samples
-                new_live_k = 0
-                hyp_samples = []
-                hyp_scores = []
-                hyp_states = []
-                for lidx in xrange(n_layers_lstm):
-                    hyp_states.append([])
-                hyp_memories = []
-                for lidx in xrange(n_layers_lstm):
-                    hyp_memories.append([])
-
-                for idx in xrange(len(new_hyp_samples)):
-                    if new_hyp_samples[idx][-1] == 0:
-                        sample.append(new_hyp_samples[idx])
-                        sample_score.append(new_hyp_scores[idx])
-                        dead_k += 1
-                    else:
-                        new_live_k += 1
-                        hyp_samples.append(new_hyp_samples[idx])
-                        hyp_scores.append(new_hyp_scores[idx])
-                        for lidx in xrange(n_layers_lstm):
-                            hyp_states[lidx].append(new_hyp_states[lidx][idx])
-                        for lidx in xrange(n_layers_lstm):
-                            hyp_memories[lidx].append(new_hyp_memories[lidx][idx])
-                hyp_scores = np.array(hyp_scores)
-                live_k = new_live_k
-
-                if new_live_k < 1:
+                dead = word_indices == 0
+                sample += [list(new_hyp_samples[idx, :ii + 1]) for idx in np.flatnonzero(dead)]
+                sample_score += list(costs[dead])
+                dead_k += dead.sum()
+
+                live = ~dead
+                hyp_samples = new_hyp_samples[live]
+                hyp_scores = costs[live]
+                live_k = hyp_scores.shape[0]
+
+                if live_k < 1:
                     break
                 if dead_k >= k:
                     break
 
-                next_w = np.array([w[-1] for w in hyp_samples])
-                next_state = []
-                for lidx in xrange(n_layers_lstm):
-                    next_state.append(np.array(hyp_states[lidx]))
-                next_memory = []
-                for lidx in xrange(n_layers_lstm):
-                    next_memory.append(np.array(hyp_memories[lidx]))
+                next_w = word_indices[live].astype('int32')
+                next_state = [state[trans_indices[live]] for state in next_state]
+                next_memory = [memory[trans_indices[live]] for memory in next_memory]
 
         if not stochastic:
             # dump every remaining one
             if live_k > 0:
-                for idx in xrange(live_k):
-                    sample.append(hyp_samples[idx])
-                    sample_score.append(hyp_scores[idx])
+                sample += [list(seq[:ii + 1]) for seq in hyp_samples]
+                sample_score += list(hyp_scores)
 
         return sample, sample_score, next_state, next_memory
 
+    def gen_sample_batch(self, sess, f_init, f_next, ctxs, ctx_masks, options, k=1, maxlen=30):
+        '''
+        beam search over n videos at once, every f_next call advancing the live hypotheses of all of them
+        ctxs: (n,28,2048) (n, f, dim_ctx)
+        ctx_masks: (n,28) (n, f)
+
+        returns a list of (sample, sample_score) per video, as gen_sample gives them with the same k
+        '''
+        n_videos = ctxs.shape[0]
+        n_layers_lstm = 2
+
+        # [(n,512),(n,512),(n,512),(n,512),(n,28,2048)]
+        rval = sess.run(f_init, feed_dict={
+                    "ctx_batch_sampler:0": ctxs,
+                    "ctx_mask_batch_sampler:0": ctx_masks
+                })
+        next_state = rval[:n_layers_lstm]
+        next_memory = rval[n_layers_lstm:2 * n_layers_lstm]
+        feed_dict = {"ctx_batch_sampler:0": ctxs,
+                     "pctx_batch_sampler:0": rval[2 * n_layers_lstm]}
+
+        sample = [[] for _ in xrange(n_videos)]
+        sample_score = [[] for _ in xrange(n_videos)]
+        hyp_samples = [np.zeros((1, maxlen), dtype='int32') for _ in xrange(n_videos)]
+        hyp_scores = [np.zeros(1).astype('float32') for _ in xrange(n_videos)]
+        dead_k = [0] * n_videos
+        live_videos = range(n_videos)   # videos still decoding, in the order of their rows in f_next
+        next_vid = np.arange(n_videos).astype('int32')  # video of every row
+        next_w = -1 * np.ones((n_videos,)).astype('int32')
+        for ii in xrange(maxlen):
+            # return [(m, vocab_size), (m, 512), (m, 512), (m, 512), (m, 512)], m = live hypotheses of all videos
+            feed_dict.update({
+                        "x_sampler:0": next_w,
+                        "ctx_idx_sampler:0": next_vid,
+                        'bo_init_state_sampler:0': next_state[0],
+                        'to_init_state_sampler:0': next_state[1],
+                        'bo_init_memory_sampler:0': next_memory[0],
+                        'to_init_memory_sampler:0': next_memory[1]
+                    })
+            rval = sess.run(f_next, feed_dict=feed_dict)
+            next_p = rval[0]
+
+            rows = []   # rows of next_p the new live hypotheses come from
+            words = []
+            vids = []
+            still_live = []
+            start = 0
+            for vid in live_videos:
+                live_k = hyp_scores[vid].shape[0]
+                trans_indices, word_indices, costs = beam_candidates(hyp_scores[vid], next_p[start:start + live_k],
+                                                                     k - dead_k[vid])
+                new_hyp_samples = hyp_samples[vid][trans_indices]
+                new_hyp_samples[:, ii] = word_indices
+
+                dead = word_indices == 0
+                sample[vid] += [list(new_hyp_samples[idx, :ii + 1]) for idx in np.flatnonzero(dead)]
+                sample_score[vid] += list(costs[dead])
+                dead_k[vid] += dead.sum()
+
+                live = ~dead
+                hyp_samples[vid] = new_hyp_samples[live]
+                hyp_scores[vid] = costs[live]
+
+                # finished videos keep their live hypotheses, dumped below
+                if live.any() and dead_k[vid] < k:
+                    still_live.append(vid)
+                    rows.append(start + trans_indices[live])
+                    words.append(word_indices[live])
+                    vids.append(np.repeat(vid, live.sum()))
+                start += live_k
+            live_videos = still_live
+            if len(live_videos) < 1:
+                break
+
+            rows = np.concatenate(rows)
+            next_w = np.concatenate(words).astype('int32')
+            next_vid = np.concatenate(vids).astype('int32')
+            next_state = [rval[1 + lidx][rows] for lidx in xrange(n_layers_lstm)]
+            next_memory = [rval[1 + n_layers_lstm + lidx][rows] for lidx in xrange(n_layers_lstm)]
+
+        # dump every remaining one
+        for vid in xrange(n_videos):
+            sample[vid] += [list(seq[:ii + 1]) for seq in hyp_samples[vid]]
+            sample_score[vid] += list(hyp_scores[vid])
+        return zip(sample, sample_score)
+
+    def gen_sample_graph(self, sess, f_beam, ctxs, ctx_masks, maxlen=30):
+        '''
+        beam search of n videos with the graph of build_beam_search
+        ctxs: (n,28,2048) (n, f, dim_ctx)
+        ctx_masks: (n,28) (n, f)
+
+        returns a list of (sample, sample_score) per video, as gen_sample gives them
+        '''
+        samples, scores, lengths = sess.run(f_beam, feed_dict={
+                    "ctx_batch_sampler:0": ctxs,
+                    "ctx_mask_batch_sampler:0": ctx_masks,
+                    "beam_maxlen:0": maxlen
+                })
+        rval = []
+        for vid_samples, vid_scores, vid_lengths in zip(samples, scores, lengths):
+            used = np.isfinite(vid_scores)
+            rval.append(([list(ss[:ll]) for ss, ll in zip(vid_samples[used], vid_lengths[used])],
+                         list(vid_scores[used])))
+        return rval
+
     def pred_probs(self, sess, engine, whichset, f_log_probs, verbose=True):
         probs = []
         n_done = 0
@@ -383,7 +657,7 @@ class Model(object):
         perp = 2 ** (np.sum(NLL) / np.sum(L) / np.log(2))
         return -1 * np.mean(probs), perp
 
-    def sample_execute(self, sess, engine, options, tfparams, f_init, f_next, x, ctx, ctx_mask):
+    def sample_execute(self, sess, engine, options, tfparams, f_init, f_next, x, ctx, ctx_mask, f_beam=None):
         stochastic = not options['beam_search']
         if stochastic:
             beam = 1
@@ -392,14 +666,22 @@ class Model(object):
         # x = (t,64)
         # ctx = (64,28,2048)
         # ctx_mask = (64,28)
-        for jj in xrange(np.minimum(10, x.shape[1])):
-            sample, score, _, _ = self.gen_sample(sess, tfparams, f_init, f_next, ctx[jj], ctx_mask[jj],
-                                                  options, k=beam, maxlen=30, stochastic=stochastic)
-            if not stochastic:
-                best_one = np.argmin(score)
-                sample = sample[best_one]
+        n_samples = np.minimum(10, x.shape[1])
+        if f_beam is not None and not stochastic:
+            # one sess.run for all of them
+            samples = [sample[np.argmin(score)] for sample, score in
+                       self.gen_sample_graph(sess, f_beam, ctx[:n_samples], ctx_mask[:n_samples], maxlen=30)]
+        for jj in xrange(n_samples):
+            if f_beam is not None and not stochastic:
+                sample = samples[jj]
             else:
-                sample = sample
+                sample, score, _, _ = self.gen_sample(sess, tfparams, f_init, f_next, ctx[jj], ctx_mask[jj],
+                                                      options, k=beam, maxlen=30, stochastic=stochastic)
+                if not stochastic:
+                    best_one = np.argmin(score)
+                    sample = sample[best_one]
+                else:
+                    sample = sample
             print 'Truth ', jj, ': ',
             for vv in x[:, jj]:
                 if vv == 0:
@@ -8,6 +8,50 @@ import data_engine
 import tensorflow as tf
 import numpy as np
 import metrics
+import evaluator
+import cocoeval
+
+def sampler_placeholders(ctx_frames, ctx_dim, lstm_dim):
+    # inputs of the sampler, fed by name in Model.gen_sample
+    CTX_SAMPLER = tf.placeholder(tf.float32, shape=(ctx_frames, ctx_dim), name='ctx_sampler')
+    CTX_MASK_SAMPLER = tf.placeholder(tf.float32, shape=(ctx_frames), name='ctx_mask_sampler')
+    X_SAMPLER = tf.placeholder(tf.int32, shape=(None,), name='x_sampler')   # DOUBT 1 or None ?
+    BO_INIT_STATE_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='bo_init_state_sampler')
+    TO_INIT_STATE_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='to_init_state_sampler')
+    BO_INIT_MEMORY_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='bo_init_memory_sampler')
+    TO_INIT_MEMORY_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='to_init_memory_sampler')
+    PCTX_SAMPLER = tf.placeholder(tf.float32, shape=(ctx_frames, ctx_dim), name='pctx_sampler')
+    return CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+        BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER
+
+def batch_sampler_placeholders(ctx_frames, ctx_dim):
+    # inputs of the batched sampler, fed by name in Model.gen_sample_batch along with
+    # x_sampler and the state placeholders of sampler_placeholders
+    CTX_BATCH_SAMPLER = tf.placeholder(tf.float32, shape=(None, ctx_frames, ctx_dim), name='ctx_batch_sampler')
+    CTX_MASK_BATCH_SAMPLER = tf.placeholder(tf.float32, shape=(None, ctx_frames), name='ctx_mask_batch_sampler')
+    CTX_IDX_SAMPLER = tf.placeholder(tf.int32, shape=(None,), name='ctx_idx_sampler')
+    PCTX_BATCH_SAMPLER = tf.placeholder(tf.float32, shape=(None, ctx_frames, ctx_dim), name='pctx_batch_sampler')
+    return CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, CTX_IDX_SAMPLER, PCTX_BATCH_SAMPLER
+
+def voc_sampler_placeholder(vocab_size):
+    # word ids that the sampler computes the probabilities of, fed by name in Model.gen_sample
+    # with restrict_voc, every word when not fed
+    return tf.placeholder_with_default(tf.range(vocab_size), shape=(None,), name='voc_sampler')
+
+def build_train_step(use_noise, inputs, fetches):
+    '''
+    The ops of train_step, built before the graph is finalized: the dropout switch, the
+    placeholders inputs fed from a minibatch (X, MASK, CTX, CTX_MASK and CTX_IDX or None)
+    and the fetches of one update.
+    '''
+    return {'noise_on': tf.assign(use_noise, True), 'inputs': inputs, 'fetches': fetches}
+
+def train_step(sess, step_ops, batch):
+    # one update on a minibatch with dropout on, the values of the fetches
+    sess.run(step_ops['noise_on'])
+    feed_dict = dict((placeholder, value) for placeholder, value in zip(step_ops['inputs'], batch)
+                     if placeholder is not None)
+    return sess.run(step_ops['fetches'], feed_dict=feed_dict)
 
 def train(model_options,
         dataset_name = 'MSVD',
@@ -53,7 +97,20 @@ def train(model_options,
         from_dir = '',
         ctx_frames = 28, # 26 when compare
         random_seed = 1234,
-        beam_search = True
+        beam_search = True,
+        use_feats_store = False,
+        prefetch_depth = 0, # minibatches assembled ahead on background threads, 0 to disable
+        prefetch_workers = 1,
+        n_length_buckets = 0,   # group captions of similar length into minibatches, 0 to disable
+        caps_per_video = 0, # minibatches of mb_size_train/caps_per_video videos x caps_per_video captions, 0 to disable
+        decode_batch_size = 1,  # videos beam searched together in validation, 1 to decode one at a time
+        graph_beam_search = False,  # beam search inside the graph with tf.while_loop
+        async_eval = False, # validate checkpoints in a separate process while training goes on
+        decode_processes = 0,   # CPU processes beam searching validation, 0 to decode in the training session
+        fast_scoring = False,   # validate with fast_scorer, the best model gets the full COCO scores at the end
+        restrict_voc = 0,   # decode over the restrict_voc most frequent words and those of similar training videos, 0 for every word
+        restrict_voc_neighbors = 5, # similar training videos whose words restrict_voc adds
+        softmax_samples = 0 # train with a sampled softmax over this many words, 0 for the full softmax
         ):
 
     tf.set_random_seed(random_seed)
@@ -63,7 +120,9 @@ def train(model_options,
     print 'loading data'
     engine = data_engine.Movie2Caption(dataset_name,cnn_name,train_data_ids_path, val_data_ids_path, test_data_ids_path,
                 vocab_path, reverse_vocab_path, mb_size_train, mb_size_test, maxlen_caption,
-                train_caps_path, val_caps_path, test_caps_path, feats_dir)
+                train_caps_path, val_caps_path, test_caps_path, feats_dir,
+                use_feats_store=use_feats_store, ctx_frames=ctx_frames, n_length_buckets=n_length_buckets,
+                caps_per_video=caps_per_video)
 
     model_options['ctx_dim'] = engine.ctx_dim
     ctx_dim = engine.ctx_dim
@@ -88,27 +147,49 @@ def train(model_options,
     # context: #samples x #annotations x dim
     CTX = tf.placeholder(tf.float32, shape=(None, ctx_frames, ctx_dim), name='ctx')
     CTX_MASK = tf.placeholder(tf.float32, shape=(None, ctx_frames), name='ctx_mask')
+    if caps_per_video > 0:
+        # row of CTX of every caption, so that captions of a video share one context
+        CTX_IDX = tf.placeholder_with_default(tf.range(tf.shape(CTX)[0]), shape=(None,), name='ctx_idx')
+        prepare_fn = data_engine.prepare_data_grouped
+    else:
+        CTX_IDX = None
+        prepare_fn = data_engine.prepare_data
 
-    CTX_SAMPLER = tf.placeholder(tf.float32, shape=(ctx_frames, ctx_dim), name='ctx_sampler')
-    CTX_MASK_SAMPLER = tf.placeholder(tf.float32, shape=(ctx_frames), name='ctx_mask_sampler')
-    X_SAMPLER = tf.placeholder(tf.int32, shape=(None,), name='x_sampler')   # DOUBT 1 or None ?
-    BO_INIT_STATE_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='bo_init_state_sampler')
-    TO_INIT_STATE_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='to_init_state_sampler')
-    BO_INIT_MEMORY_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='bo_init_memory_sampler')
-    TO_INIT_MEMORY_SAMPLER = tf.placeholder(tf.float32, shape=(None,lstm_dim), name='to_init_memory_sampler')
+    CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, \
+        BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER, PCTX_SAMPLER = sampler_placeholders(ctx_frames, ctx_dim, lstm_dim)
 
     # create tensorflow variables
     print 'buliding model'
     tfparams = utils.init_tfparams(params)
 
-    use_noise, COST, extra = model.build_model(tfparams, model_options, X, MASK, CTX, CTX_MASK)
+    use_noise, COST, extra = model.build_model(tfparams, model_options, X, MASK, CTX, CTX_MASK, CTX_IDX,
+                                               word_counts=engine.get_word_counts())
     ALPHAS = extra[1]   # (t,64,28)
     BETAS = extra[2]    # (t,64)
+    TRAIN_COST = extra[3]   # (64,) sampled with softmax_samples, COST otherwise
 
     print 'buliding sampler'
+    # the batched samplers decode over every word
+    assert restrict_voc == 0 or (decode_batch_size == 1 and not graph_beam_search)
+    VOC_SAMPLER = voc_sampler_placeholder(model_options['vocab_size']) if restrict_voc > 0 else None
     f_init, f_next = model.build_sampler(tfparams, model_options, use_noise,
                                 CTX_SAMPLER, CTX_MASK_SAMPLER, X_SAMPLER, BO_INIT_STATE_SAMPLER,
-                                TO_INIT_STATE_SAMPLER, BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER)
+                                TO_INIT_STATE_SAMPLER, BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER,
+                                pctx_sampler=PCTX_SAMPLER, voc_sampler=VOC_SAMPLER)
+    if decode_batch_size > 1 or graph_beam_search:
+        CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, CTX_IDX_SAMPLER, PCTX_BATCH_SAMPLER = \
+            batch_sampler_placeholders(ctx_frames, ctx_dim)
+    if decode_batch_size > 1:
+        f_init_batch, f_next_batch = model.build_batch_sampler(tfparams, model_options, use_noise,
+                                CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, X_SAMPLER, CTX_IDX_SAMPLER, PCTX_BATCH_SAMPLER,
+                                BO_INIT_STATE_SAMPLER, TO_INIT_STATE_SAMPLER, BO_INIT_MEMORY_SAMPLER, TO_INIT_MEMORY_SAMPLER)
+    else:
+        f_init_batch, f_next_batch = None, None
+    if graph_beam_search:
+        f_beam = model.build_beam_search(tfparams, model_options, use_noise,
+                                CTX_BATCH_SAMPLER, CTX_MASK_BATCH_SAMPLER, k=5)
+    else:
+        f_beam = None
 
     print 'building f_log_probs'
     f_log_probs = -COST
@@ -119,7 +200,8 @@ def train(model_options,
     print len(wrt),len(trainables)
     # assert len(wrt)==len(trainables)
 
-    COST = tf.reduce_mean(COST, name="LOSS")
+    # f_log_probs keeps the exact cost for validation
+    COST = tf.reduce_mean(TRAIN_COST, name="LOSS")
     if decay_c > 0.:
         decay_c = tf.Variable(np.float32(decay_c), trainable=False, name='decay_c')
         weight_decay = 0.
@@ -142,9 +224,6 @@ def train(model_options,
     else:
         alpha_reg_2 = tf.zeros_like(COST)
 
-    print 'building f_alpha'
-    f_alpha = [ALPHAS, BETAS]
-
     print 'build train fns'
     UPDATE_OPS = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     with tf.control_dependencies(UPDATE_OPS):
@@ -156,6 +235,11 @@ def train(model_options,
         capped_grads_and_vars = zip(gradients, variables)
         TRAIN_OP = optimizer.apply_gradients(capped_grads_and_vars)
 
+    # dropout switches, built once so that the train loop adds no op to the graph
+    # one forward pass gives the update and the cost, alphas and betas it was computed from
+    step_ops = build_train_step(use_noise, (X, MASK, CTX, CTX_MASK, CTX_IDX), [COST, ALPHAS, BETAS, TRAIN_OP])
+    NOISE_OFF = tf.assign(use_noise, False)
+
 
     # Initialize all variables
     var_init = tf.global_variables_initializer()
@@ -177,6 +261,10 @@ def train(model_options,
     queue = None
     rqueue = None
     shared_params = None
+    if decode_processes > 0 and not async_eval:
+        # before the session: the decoders must not inherit its CUDA context
+        processes, queue, rqueue, shared_params = metrics.start_cpu_decoders(model_options,
+                                                                             decode_processes, params)
 
     uidx = 0
     uidx_best_blue = 0
@@ -194,43 +282,140 @@ def train(model_options,
     test_err = -1
     test_perp = -1
 
+    if async_eval:
+        # before the session: the worker must not inherit its CUDA context
+        async_evaluator = evaluator.AsyncEvaluator(model_options, save_dir)
+    # METEOR kept running across the validations
+    scorer_service = cocoeval.ScorerService()
+
     # Launch the graph
     with tf.Session() as sess:
         sess.run(var_init)
         if reload_model:
             print 'restoring model...'
             saver.restore(sess, from_dir+"model_best_so_far.ckpt")
+        # fail fast on any op created inside the loop
+        sess.graph.finalize()
+
+        def compute_score(scoring):
+            # COCO scores of the beam search samples of the current parameters on val and test
+            return metrics.compute_score(sess=sess,
+                model_type='attention',
+                model_archive=None,
+                options=model_options,
+                engine=engine,
+                save_dir=save_dir,
+                beam=5, n_process=decode_processes,
+                whichset='both',
+                # the pool is only started without async_eval, decoding in the session otherwise
+                on_cpu=processes is not None,
+                processes=processes, queue=queue, rqueue=rqueue,
+                shared_params=shared_params, metric=metric,
+                one_time=False,
+                f_init=f_init, f_next=f_next, model=model,
+                f_init_batch=f_init_batch, f_next_batch=f_next_batch,
+                decode_batch_size=decode_batch_size, f_beam=f_beam,
+                tfparams=tfparams, scorer_service=scorer_service, scoring=scoring)
+
+        def record_evaluation(eval_eidx, eval_uidx, checkpoint, valid_err, valid_perp, scores, eval_duration):
+            '''
+            Append an evaluation to history_errs and save the best models. checkpoint holds the
+            evaluated parameters, None for the current ones. Returns whether valid_err is the
+            best so far, None for the first evaluation.
+            '''
+            def save_model(path):
+                if checkpoint is None:
+                    saver.save(sess, path)
+                else:
+                    evaluator.copy_checkpoint(checkpoint, path)
+            '''
+             {'blue': {'test': [-1], 'valid': [77.7, 60.5, 48.7, 38.5, 38.3]},
+             'alternative_valid': {'Bleu_3': 0.40702270203174923,
+             'Bleu_4': 0.29276570520368456,
+             'CIDEr': 0.25247168210607884,
+             'Bleu_2': 0.529069629270047,
+             'Bleu_1': 0.6804308797115253,
+             'ROUGE_L': 0.51083584331688392},
+             'meteor': {'test': [-1], 'valid': [0.282787550236724]}}
+            '''
+            valid_B1 = scores['valid']['Bleu_1']
+            valid_B2 = scores['valid']['Bleu_2']
+            valid_B3 = scores['valid']['Bleu_3']
+            valid_B4 = scores['valid']['Bleu_4']
+            valid_Rouge = scores['valid']['ROUGE_L']
+            valid_Cider = scores['valid']['CIDEr']
+            # no METEOR with fast_scoring
+            valid_meteor = scores['valid'].get('METEOR', -1)
+            test_B1 = scores['test']['Bleu_1']
+            test_B2 = scores['test']['Bleu_2']
+            test_B3 = scores['test']['Bleu_3']
+            test_B4 = scores['test']['Bleu_4']
+            test_Rouge = scores['test']['ROUGE_L']
+            test_Cider = scores['test']['CIDEr']
+            test_meteor = scores['test'].get('METEOR', -1)
+            print 'update %d: computing meteor/blue score used %.4f sec, '\
+              'blue score: %.1f, meteor score: %.1f'%(
+            eval_uidx, eval_duration, valid_B4, valid_meteor)
+            history_errs.append([eval_eidx, eval_uidx, train_err, train_perp,
+                                 valid_perp, test_perp,
+                                 valid_err, test_err,
+                                 valid_B1, valid_B2, valid_B3,
+                                 valid_B4, valid_meteor, valid_Rouge, valid_Cider,
+                                 test_B1, test_B2, test_B3,
+                                 test_B4, test_meteor, test_Rouge, test_Cider])
+            np.savetxt(save_dir+'train_valid_test.txt',
+                          history_errs, fmt='%.3f')
+            print 'save validation results to %s'%save_dir
+            # save best model according to the best blue or meteor
+            if len(history_errs) > 1 and \
+              valid_B4 > np.array(history_errs)[:-1,11].max():
+                print 'Saving to %s...'%save_dir,
+                np.savez(
+                    save_dir+'model_best_blue_or_meteor.npz',
+                    history_errs=history_errs)
+                save_model(save_dir+'model_best_blue_or_meteor.ckpt') # DOUBT
+            if test_B4>0.52 and test_meteor>0.32:
+                print 'Saving to %s...'%save_dir,
+                np.savez(
+                    save_dir+'model_'+str(eval_uidx)+'.npz',
+                    history_errs=history_errs)
+                save_model(save_dir+'model_'+str(eval_uidx)+'.ckpt')
+
+            improved = None
+            if len(history_errs) > 1 and \
+              valid_err < np.array(history_errs)[:-1,6].min():
+                # best_p = utils.unzip(tparams) # DOUBT
+                print 'Saving to %s...'%save_dir,
+                np.savez(save_dir+'model_best_so_far.npz',
+                        history_errs=history_errs)
+                save_model(save_dir+'model_best_so_far.ckpt')
+                utils.write_to_json(model_options, '%smodel_options.json'%save_dir)
+                print 'Done'
+                improved = True
+            elif len(history_errs) > 1:
+                improved = False
+            if checkpoint is not None:
+                evaluator.remove_checkpoint(checkpoint)
+            return improved
         for eidx in xrange(max_epochs):
+            if eidx > 0:
+                engine.shuffle_train_minibatches()
             n_samples = 0
             train_costs = []
             grads_record = []
-            for idx in engine.kf_train:
-                tags = [engine.train_data_ids[index] for index in idx]
+            for tags, batch, pd_duration in data_engine.iterate_minibatches(engine, engine.kf_train,
+                                    engine.train_data_ids, "train", prefetch_depth, prefetch_workers, prepare_fn):
                 n_samples += len(tags)
                 uidx += 1
-                
-                sess.run(tf.assign(use_noise, True))
 
-                pd_start = time.time()
-                x, mask, ctx, ctx_mask = data_engine.prepare_data(engine, tags, mode="train")
-                pd_duration = time.time() - pd_start
+                x, mask, ctx, ctx_mask = batch[:4]
                 if x is None:
                     print 'Minibatch with zero sample under length ', maxlen
                     continue
 
                 # writer = tf.summary.FileWriter("graph_cost", sess.graph)
-                cost, alphas, betas = sess.run([COST,ALPHAS,BETAS], feed_dict={
-                                        X: x,
-                                        MASK: mask,
-                                        CTX: ctx,
-                                        CTX_MASK: ctx_mask})
-
                 ud_start = time.time()
-                sess.run(TRAIN_OP, feed_dict={
-                                        X: x,
-                                        MASK: mask,
-                                        CTX: ctx,
-                                        CTX_MASK: ctx_mask})
+                cost, alphas, betas, _ = train_step(sess, step_ops, batch)
                 ud_duration = time.time() - ud_start
 
                 # writer.close()
@@ -252,11 +437,6 @@ def train(model_options,
                         ', update time spent (sec): ', ud_duration, \
                         ', save_dir: ', save_dir, '\n'
                     
-                    alphas, betas = sess.run(f_alpha, feed_dict={
-                                            X: x,
-                                            MASK: mask,
-                                            CTX: ctx,
-                                            CTX_MASK: ctx_mask})
                     counts = mask.sum(0)
                     betas_mean = (betas * mask).sum(0) / counts
                     betas_mean = betas_mean.mean()
@@ -278,13 +458,17 @@ def train(model_options,
                     pass
 
                 if np.mod(uidx, sampleFreq) == 0:
-                    sess.run(tf.assign(use_noise, False))
+                    sess.run(NOISE_OFF)
                     print '------------- sampling from train ----------'
                     x_s = x     # (t,m)
                     mask_s = mask   # (t,m)
                     ctx_s = ctx     # (m,28,2048)
                     ctx_mask_s = ctx_mask   # (m,28)
-                    model.sample_execute(sess, engine, model_options, tfparams, f_init, f_next, x_s, ctx_s, ctx_mask_s)
+                    if CTX_IDX is not None:
+                        ctx_s = ctx[batch[4]]
+                        ctx_mask_s = ctx_mask[batch[4]]
+                    model.sample_execute(sess, engine, model_options, tfparams, f_init, f_next, x_s, ctx_s, ctx_mask_s,
+                                         f_beam=f_beam)
                     # print '------------- sampling from valid ----------'
                     # idx = engine.kf_val[np.random.randint(1, len(engine.kf_val) - 1)]
                     # tags = [engine.val_data_ids[index] for index in idx]
@@ -292,13 +476,9 @@ def train(model_options,
                     # model.sample_execute(sess, engine, model_options, tfparams, f_init, f_next, x_s, ctx_s, ctx_mask_s)
                     # print ""
 
+                evaluations = []
                 if validFreq != -1 and np.mod(uidx, validFreq) == 0:
                     t0_valid = time.time()
-                    alphas, _ = sess.run(f_alpha, feed_dict={
-                                            X: x,
-                                            MASK: mask,
-                                            CTX: ctx,
-                                            CTX_MASK: ctx_mask})
                     ratio = alphas.min(-1).mean()/(alphas.max(-1)).mean()
                     alphas_ratio.append(ratio)
                     np.savetxt(save_dir+'alpha_ratio.txt',alphas_ratio)
@@ -306,115 +486,58 @@ def train(model_options,
                     np.savez(save_dir+'model_current.npz', history_errs=history_errs)
                     saver.save(sess, save_dir+'model_current.ckpt')
 
-                    sess.run(tf.assign(use_noise, False))
-
-                    train_err = -1
-                    train_perp = -1
-                    valid_err = -1
-                    valid_perp = -1
-                    test_err = -1
-                    test_perp = -1
-                    if not debug:
-                        # first compute train cost
-                        if 0:
-                            print 'computing cost on trainset'
-                            train_err, train_perp = model.pred_probs(sess, engine, 'train', 
-                                    f_log_probs, verbose=model_options['verbose'])
-                        else:
-                            train_err = 0.
-                            train_perp = 0.
-                        if 1:
-                            print 'validating...'
-                            valid_err, valid_perp = model.pred_probs(sess, engine, 'val',
-                                    f_log_probs, verbose=model_options['verbose'])
-                        else:
-                            valid_err = 0.
-                            valid_perp = 0.
-                        if 0:
-                            print 'testing...'
-                            test_err, test_perp = model.pred_probs(sess, engine, 'test',
-                                    f_log_probs, verbose=model_options['verbose'])
-                        else:
-                            test_err = 0.
-                            test_perp = 0.
-                    
-                    mean_ranking = 0
-                    blue_t0 = time.time()
-                    scores, processes, queue, rqueue, shared_params = \
-                        metrics.compute_score(sess=sess,
-                        model_type='attention',
-                        model_archive=None,
-                        options=model_options,
-                        engine=engine,
-                        save_dir=save_dir,
-                        beam=5, n_process=5,
-                        whichset='both',
-                        on_cpu=False,   
-                        processes=processes, queue=queue, rqueue=rqueue,
-                        shared_params=shared_params, metric=metric,
-                        one_time=False,
-                        f_init=f_init, f_next=f_next, model=model
-                        )
-                    '''
-                     {'blue': {'test': [-1], 'valid': [77.7, 60.5, 48.7, 38.5, 38.3]},
-                     'alternative_valid': {'Bleu_3': 0.40702270203174923,
-                     'Bleu_4': 0.29276570520368456,
-                     'CIDEr': 0.25247168210607884,
-                     'Bleu_2': 0.529069629270047,
-                     'Bleu_1': 0.6804308797115253,
-                     'ROUGE_L': 0.51083584331688392},
-                     'meteor': {'test': [-1], 'valid': [0.282787550236724]}}
-                    '''
-                    valid_B1 = scores['valid']['Bleu_1']
-                    valid_B2 = scores['valid']['Bleu_2']
-                    valid_B3 = scores['valid']['Bleu_3']
-                    valid_B4 = scores['valid']['Bleu_4']
-                    valid_Rouge = scores['valid']['ROUGE_L']
-                    valid_Cider = scores['valid']['CIDEr']
-                    valid_meteor = scores['valid']['METEOR']
-                    test_B1 = scores['test']['Bleu_1']
-                    test_B2 = scores['test']['Bleu_2']
-                    test_B3 = scores['test']['Bleu_3']
-                    test_B4 = scores['test']['Bleu_4']
-                    test_Rouge = scores['test']['ROUGE_L']
-                    test_Cider = scores['test']['CIDEr']
-                    test_meteor = scores['test']['METEOR']
-                    print 'computing meteor/blue score used %.4f sec, '\
-                      'blue score: %.1f, meteor score: %.1f'%(
-                    time.time()-blue_t0, valid_B4, valid_meteor)
-                    history_errs.append([eidx, uidx, train_err, train_perp,
-                                         valid_perp, test_perp,
-                                         valid_err, test_err,
-                                         valid_B1, valid_B2, valid_B3,
-                                         valid_B4, valid_meteor, valid_Rouge, valid_Cider,
-                                         test_B1, test_B2, test_B3,
-                                         test_B4, test_meteor, test_Rouge, test_Cider])
-                    np.savetxt(save_dir+'train_valid_test.txt',
-                                  history_errs, fmt='%.3f')
-                    print 'save validation results to %s'%save_dir
-                    # save best model according to the best blue or meteor
-                    if len(history_errs) > 1 and \
-                      valid_B4 > np.array(history_errs)[:-1,11].max():
-                        print 'Saving to %s...'%save_dir,
-                        np.savez(
-                            save_dir+'model_best_blue_or_meteor.npz',
-                            history_errs=history_errs)
-                        saver.save(sess, save_dir+'model_best_blue_or_meteor.ckpt') # DOUBT
-                    if len(history_errs) > 1 and \
-                      valid_err < np.array(history_errs)[:-1,6].min():
-                        # best_p = utils.unzip(tparams) # DOUBT
+                    if async_eval:
+                        evaluations += async_evaluator.submit(sess, eidx, uidx)
+                        print 'queued update %d for evaluation'%uidx
+                    else:
+                        sess.run(NOISE_OFF)
+
+                        train_err = -1
+                        train_perp = -1
+                        valid_err = -1
+                        valid_perp = -1
+                        test_err = -1
+                        test_perp = -1
+                        if not debug:
+                            # first compute train cost
+                            if 0:
+                                print 'computing cost on trainset'
+                                train_err, train_perp = model.pred_probs(sess, engine, 'train', 
+                                        f_log_probs, verbose=model_options['verbose'])
+                            else:
+                                train_err = 0.
+                                train_perp = 0.
+                            if 1:
+                                print 'validating...'
+                                valid_err, valid_perp = model.pred_probs(sess, engine, 'val',
+                                        f_log_probs, verbose=model_options['verbose'])
+                            else:
+                                valid_err = 0.
+                                valid_perp = 0.
+                            if 0:
+                                print 'testing...'
+                                test_err, test_perp = model.pred_probs(sess, engine, 'test',
+                                        f_log_probs, verbose=model_options['verbose'])
+                            else:
+                                test_err = 0.
+                                test_perp = 0.
+                        
+                        mean_ranking = 0
+                        blue_t0 = time.time()
+                        scores, processes, queue, rqueue, shared_params = \
+                            compute_score('fast' if fast_scoring else 'coco')
+                        evaluations.append((eidx, uidx, None, valid_err, valid_perp, scores, time.time()-blue_t0))
+                if async_eval:
+                    evaluations += async_evaluator.poll()
+
+                for eval_eidx, eval_uidx, checkpoint, valid_err, valid_perp, scores, eval_duration in evaluations:
+                    improved = record_evaluation(eval_eidx, eval_uidx, checkpoint, valid_err, valid_perp,
+                                                 scores, eval_duration)
+                    if improved:
                         bad_counter = 0
                         best_valid_err = valid_err
-                        uidx_best_valid_err = uidx
-
-                        print 'Saving to %s...'%save_dir,
-                        np.savez(save_dir+'model_best_so_far.npz',
-                                history_errs=history_errs)
-                        saver.save(sess, save_dir+'model_best_so_far.ckpt')
-                        utils.write_to_json(model_options, '%smodel_options.json'%save_dir)
-                        print 'Done'
-                    elif len(history_errs) > 1 and \
-                        valid_err >= np.array(history_errs)[:-1,6].min():
+                        uidx_best_valid_err = eval_uidx
+                    elif improved is not None:
                         bad_counter += 1
                         print 'history best ',np.array(history_errs)[:,6].min()
                         print 'bad_counter ',bad_counter
@@ -422,19 +545,14 @@ def train(model_options,
                         if bad_counter > patience:
                             print 'Early Stop!'
                             estop = True
-                            break
-
-                    if test_B4>0.52 and test_meteor>0.32:
-                        print 'Saving to %s...'%save_dir,
-                        np.savez(
-                            save_dir+'model_'+str(uidx)+'.npz',
-                            history_errs=history_errs)
-                        saver.save(sess, save_dir+'model_'+str(uidx)+'.ckpt')
 
                     print 'Train ', train_err, 'Valid ', valid_err, 'Test ', test_err, \
                       'best valid err so far',best_valid_err
+                if evaluations and not async_eval:
                     print 'valid took %.2f sec'%(time.time() - t0_valid)
                     # end of validatioin
+                if estop:
+                    break
                 if debug:
                     break
 
@@ -449,6 +567,12 @@ def train(model_options,
 
         # end for loop over epochs
         print 'Optimization ended.'
+        if async_eval:
+            print 'waiting for the queued evaluations...'
+            for evaluation in async_evaluator.close():
+                if record_evaluation(*evaluation):
+                    best_valid_err = evaluation[3]
+                    uidx_best_valid_err = evaluation[1]
         
         print 'stopped at epoch %d, minibatch %d, '\
           'curent Train %.2f, current Valid %.2f, current Test %.2f '%(
@@ -464,6 +588,17 @@ def train(model_options,
             save_dir+'model_train_end.npz',
             history_errs=history_errs)
         saver.save(sess, save_dir+'model_train_end.ckpt')
+        if fast_scoring and not debug:
+            # METEOR only once, for the best model
+            if tf.train.checkpoint_exists(save_dir+'model_best_so_far.ckpt'):
+                print 'restoring the best model for the final evaluation...'
+                saver.restore(sess, save_dir+'model_best_so_far.ckpt')
+            sess.run(NOISE_OFF)
+            scores = compute_score('coco')[0]
+            utils.write_to_json(scores, save_dir+'final_scores.json')
+        if processes is not None:
+            metrics.stop_cpu_decoders(processes, queue)
+        scorer_service.close()
     return
 
 def train_util(params):
@@ -508,6 +643,45 @@ def train_util(params):
     train(params, **params)
     print('training time in total %.4f sec' % (time.time() - t0))
 
+def test_static_graph(n_steps=10):
+    # train_step, as train runs it, must not add a single op to the finalized graph
+    options = utils.load_default_params()
+    options.update({'vocab_size': 50, 'ctx_dim': 16, 'ctx_frames': 4, 'word_dim': 8, 'lstm_dim': 8})
+    model = Model()
+    with tf.Graph().as_default() as graph:
+        tfparams = utils.init_tfparams(model.init_params(options))
+        X = tf.placeholder(tf.int32, shape=(None, None), name='word_seq_x')
+        MASK = tf.placeholder(tf.float32, shape=(None, None), name='word_seq_mask')
+        CTX = tf.placeholder(tf.float32, shape=(None, options['ctx_frames'], options['ctx_dim']), name='ctx')
+        CTX_MASK = tf.placeholder(tf.float32, shape=(None, options['ctx_frames']), name='ctx_mask')
+        use_noise, COST, extra = model.build_model(tfparams, options, X, MASK, CTX, CTX_MASK)
+        COST = tf.reduce_mean(extra[3])
+        TRAIN_OP = tf.train.AdadeltaOptimizer(learning_rate=1.0, rho=0.95, epsilon=1e-06).minimize(COST)
+        step_ops = build_train_step(use_noise, (X, MASK, CTX, CTX_MASK, None), [COST, extra[1], extra[2], TRAIN_OP])
+        NOISE_OFF = tf.assign(use_noise, False)
+        var_init = tf.global_variables_initializer()
+        rng = np.random.RandomState(1234)
+        with tf.Session() as sess:
+            sess.run(var_init)
+            sess.graph.finalize()
+            n_ops = len(graph.get_operations())
+            for step in xrange(n_steps):
+                batch = (rng.randint(1, options['vocab_size'], size=(7, 3)),
+                         np.ones((7, 3), dtype='float32'),
+                         rng.rand(3, options['ctx_frames'], options['ctx_dim']).astype('float32'),
+                         np.ones((3, options['ctx_frames']), dtype='float32'))
+                cost, alphas, betas, _ = train_step(sess, step_ops, batch)
+                assert np.isfinite(cost) and sess.run(use_noise)
+                sess.run(NOISE_OFF)
+                assert len(graph.get_operations()) == n_ops, 'step %d added ops to the graph'%step
+            try:
+                sess.run(tf.assign(use_noise, True))
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('the finalized graph accepted a new op')
+    print 'graph stayed at %d ops over %d steps'%(n_ops, n_steps)
+
 if __name__ == '__main__':
     model_options = utils.load_default_params()
     train_util(model_options)
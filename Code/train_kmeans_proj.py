@@ -52,7 +52,8 @@ def train(model_options,
         from_dir = '',
         ctx_frames = 28, # 26 when compare
         random_seed = 1234,
-        beam_search = True
+        beam_search = True,
+        **kwargs    # options of train.train that this variant does not use
         ):
 
     tf.set_random_seed(random_seed)
@@ -159,6 +160,10 @@ def train(model_options,
         capped_grads_and_vars = zip(gradients, variables)
         TRAIN_OP = optimizer.apply_gradients(capped_grads_and_vars)
 
+    # dropout switches, built once so that the train loop adds no op to the graph
+    NOISE_ON = tf.assign(use_noise, True)
+    NOISE_OFF = tf.assign(use_noise, False)
+
 
     # Initialize all variables
     var_init = tf.global_variables_initializer()
@@ -203,6 +208,8 @@ def train(model_options,
         if reload_model:
             print 'restoring model...'
             saver.restore(sess, from_dir+"model_best_so_far.ckpt")
+        # fail fast on any op created inside the loop
+        sess.graph.finalize()
         for eidx in xrange(max_epochs):
             n_samples = 0
             train_costs = []
@@ -212,7 +219,7 @@ def train(model_options,
                 n_samples += len(tags)
                 uidx += 1
                 
-                sess.run(tf.assign(use_noise, True))
+                sess.run(NOISE_ON)
 
                 pd_start = time.time()
                 x, mask, ctx, ctx_mask, ctx_pca = data_engine.prepare_data(engine, tags, mode="train")
@@ -284,7 +291,7 @@ def train(model_options,
                     pass
 
                 if np.mod(uidx, sampleFreq) == 0:
-                    sess.run(tf.assign(use_noise, False))
+                    sess.run(NOISE_OFF)
                     print '------------- sampling from train ----------'
                     x_s = x     # (t,m)
                     mask_s = mask   # (t,m)
@@ -314,7 +321,7 @@ def train(model_options,
                     np.savez(save_dir+'model_current.npz', history_errs=history_errs)
                     saver.save(sess, save_dir+'model_current.ckpt')
 
-                    sess.run(tf.assign(use_noise, False))
+                    sess.run(NOISE_OFF)
 
                     train_err = -1
                     train_perp = -1
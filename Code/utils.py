@@ -96,6 +96,45 @@ def generate_minibatch_idx(dataset_size, minibatch_size):
     minibatch_idx = [idx_.tolist() for idx_ in minibatch_idx]
     return minibatch_idx
 
+def generate_bucketed_minibatch_idx(lengths, minibatch_size, n_buckets):
+    # generate idx for minibatches SGD, grouping ids of similar length so that
+    # minibatches need less padding. ids are sorted by length and split into
+    # n_buckets equally sized buckets, shuffled within each bucket, chunked,
+    # and the resulting minibatches are shuffled across buckets.
+    # output [m1, m2, m3, ..., mk] where mk is a list of indices
+    assert len(lengths) >= minibatch_size
+    order = np.argsort(np.asarray(lengths), kind='mergesort')
+    minibatch_idx = []
+    for bucket in np.array_split(order, min(n_buckets, len(order))):
+        rng_numpy.shuffle(bucket)
+        for start in xrange(0, len(bucket), minibatch_size):
+            minibatch_idx.append(bucket[start:start + minibatch_size].tolist())
+    rng_numpy.shuffle(minibatch_idx)
+    return minibatch_idx
+
+def generate_grouped_minibatch_idx(vid_idx, minibatch_size, caps_per_video):
+    # generate idx for minibatches SGD made of minibatch_size/caps_per_video videos
+    # with caps_per_video captions each, so that a video's context is shared by its
+    # captions. vid_idx gives the video of every id. every id is used once per call.
+    # output [m1, m2, m3, ..., mk] where mk is a list of indices
+    assert 0 < caps_per_video <= minibatch_size
+    vid_idx = np.asarray(vid_idx)
+    order = np.argsort(vid_idx, kind='mergesort')
+    groups = []
+    for ids in np.split(order, np.flatnonzero(np.diff(vid_idx[order])) + 1):
+        rng_numpy.shuffle(ids)
+        for start in xrange(0, len(ids), caps_per_video):
+            groups.append(ids[start:start + caps_per_video].tolist())
+    rng_numpy.shuffle(groups)
+    vids_per_minibatch = minibatch_size / caps_per_video
+    return [flatten_list_of_list(groups[start:start + vids_per_minibatch])
+            for start in xrange(0, len(groups), vids_per_minibatch)]
+
+def count_padding(minibatch_idx, lengths):
+    # number of padded timesteps over all minibatches, each padded to its longest sequence
+    lengths = np.asarray(lengths)
+    return sum(int(lengths[idx].max() * len(idx) - lengths[idx].sum()) for idx in minibatch_idx)
+
 def load_default_params():
 	return copy.deepcopy(config.params)
 